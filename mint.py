@@ -6,20 +6,36 @@ mint - small, fast and simple template engine.
 
 import os
 import re
+import sys
 import ast
+import copy
+import imp
 import mmap
 import time
+import marshal
+import hashlib
+import multiprocessing
+import tempfile
+import select
+import struct
 import fnmatch
 import logging
 import weakref
+import threading
 import itertools
+import __builtin__
 import htmlentitydefs
 from ast import Load, Store, Param
 from StringIO import StringIO
+from types import FunctionType
 from functools import partial
-from collections import deque
+from collections import OrderedDict
 from xml.etree.ElementTree import TreeBuilder as _TreeBuilder, Element
 
+__version__ = '0.5'
+# version of generated code, compiled templates of other versions are not used
+CODE_VERSION = 4
+
 ############# LEXER
 
 class BaseToken(object):
@@ -135,70 +151,100 @@ all_tokens = list(tokens) + [TOKEN_EOF, TOKEN_TEXT, TOKEN_INDENT, TOKEN_UNINDENT
 all_except = lambda *t: filter(lambda x: x not in t, all_tokens)
 re_comment = re.compile(r'\s*//')
 
+
+def master_regex(tokens):
+    '''
+    Combines regexes of tokens into one alternation. Alternatives are tried in
+    tokens order, so first matching token wins as in sequential probing.
+    Returns compiled regex and mapping of group names to tokens.
+    '''
+    groups = {}
+    alternatives = []
+    for i, token in enumerate(tokens):
+        name = 't%d' % i
+        groups[name] = token
+        alternatives.append('(?P<%s>%s)' % (name, token.regex.pattern))
+    return re.compile('|'.join(alternatives), re.U), groups
+
+re_tokens, re_tokens_groups = master_regex(tokens)
+
+
 def base_tokenizer(fp):
-    'Tokenizer. Generates tokens stream from text'
-    if isinstance(fp, StringIO):
-        template_file = fp
-        size = template_file.len
+    '''
+    Tokenizer. Generates tokens stream from text. Accepts template source
+    as string, memory map, StringIO or file object. Files are mapped to
+    memory and sliced line by line without reading the whole file into
+    a string.
+    '''
+    own_map = False
+    if isinstance(fp, (basestring, mmap.mmap)):
+        data = fp
+    elif isinstance(fp, StringIO):
+        data = fp.getvalue()
     else:
         #empty file check
         if os.fstat(fp.fileno()).st_size == 0:
             yield TOKEN_EOF, 'EOF', 0, 0
             return
-        template_file = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
-        size = template_file.size()
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        own_map = True
+    decode = not isinstance(data, unicode)
+    search = re_tokens.search
+    groups = re_tokens_groups
+    find = data.find
+    size = len(data)
+    start = 0
     lineno = 0
-    while 1:
-        lineno += 1
-        pos = 1
-
-        # end of file
-        if template_file.tell() == size:
-            yield TOKEN_EOF, 'EOF', lineno, 0
-            break
-
-        # now we tokinize line by line
-        line = template_file.readline().decode('utf-8')
-        line = line.replace('\r\n', '')
-        line = line.replace('\n', '')
-        # ignoring non XML comments
-        if re_comment.match(line):
-            continue
+    try:
+        while 1:
+            lineno += 1
+            pos = 1
+
+            # end of file
+            if start == size:
+                yield TOKEN_EOF, 'EOF', lineno, 0
+                break
+
+            # now we tokinize line by line
+            end = find('\n', start)
+            end = size if end == -1 else end + 1
+            line = data[start:end]
+            start = end
+            if decode:
+                line = line.decode('utf-8')
+            line = line.replace('\r\n', '')
+            line = line.replace('\n', '')
+            # ignoring non XML comments
+            if re_comment.match(line):
+                continue
 
-        last_text = deque()
-        while line:
-            line_len = len(line)
-            for token in tokens:
-                m = token.regex.match(line)
-                if m:
-                    if last_text:
-                        yield TOKEN_TEXT, ''.join(last_text), lineno, pos
-                        pos += len(last_text)
-                        last_text.clear()
-                    offset, value = m.end(), m.group()
-                    line = line[offset:]
-                    yield token, value, lineno, pos
-                    pos += offset
+            # every char between two matched tokens is text
+            offset, line_len = 0, len(line)
+            while offset < line_len:
+                m = search(line, offset)
+                if m is None:
                     break
-
-            # we did not get right in tokens list, so next char is text
-            if line_len == len(line):
-                last_text.append(line[0])
-                line = line[1:]
-
-        if last_text:
-            yield TOKEN_TEXT, ''.join(last_text), lineno, pos
-            pos += len(last_text)
-            last_text.clear()
-        yield TOKEN_NEWLINE, '\n', lineno, pos
-
-    # all work is done
-    template_file.close()
-
-
-def indent_tokenizer(tokens_stream):
+                m_start, m_end = m.span()
+                if m_start > offset:
+                    yield TOKEN_TEXT, line[offset:m_start], lineno, pos
+                    pos += m_start - offset
+                yield groups[m.lastgroup], m.group(), lineno, pos
+                pos += m_end - m_start
+                offset = m_end
+
+            if offset < line_len:
+                yield TOKEN_TEXT, line[offset:], lineno, pos
+                pos += line_len - offset
+            yield TOKEN_NEWLINE, '\n', lineno, pos
+    finally:
+        # all work is done
+        if own_map:
+            data.close()
+
+
+def indent_tokenizer(tokens_stream, indent=0):
+    # indent - width of one indention level, 0 means first indention
     current_indent = 0
-    indent = 0
     for tok in tokens_stream:
         token, value, lineno, pos = tok
         # backslashed line transfer
@@ -272,19 +318,101 @@ UNSAFE_CHARS_ENTITIES_IN_ATTR.append(("'",'&#39;'))
 UNSAFE_CHARS_ENTITIES_REVERSED = [(v,k) for k,v in UNSAFE_CHARS_ENTITIES]
 
 
-def escape(obj, ctx='tag'):
+NUMBER_TYPES = frozenset([int, long, float])
+
+
+def escape_text(text):
+    '''
+    Replaces UNSAFE_CHARS_ENTITIES in unicode text. Text without unsafe chars
+    is returned as is.
+    '''
+    if u'&' in text or u'<' in text or u'>' in text or u'"' in text or u"'" in text:
+        return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')\
+                   .replace(u'"', u'&quot;').replace(u"'", u'&#39;')
+    return text
+
+
+def escape_markup_in_attr(markup):
+    '''
+    Replaces UNSAFE_CHARS_ENTITIES_IN_ATTR in safe markup. Markup without
+    unsafe chars is returned as is.
+    '''
+    if u'<' in markup or u'>' in markup or u'"' in markup or u"'" in markup:
+        return markup.replace(u'<', u'&lt;').replace(u'>', u'&gt;')\
+                     .replace(u'"', u'&quot;').replace(u"'", u'&#39;')
+    return markup
+
+
+def escape_tag(obj):
+    'Escapes value of expression in tag content'
+    cls = obj.__class__
+    if cls is unicode:
+        return escape_text(obj)
+    if cls in NUMBER_TYPES:
+        return unicode(obj)
+    if cls is Markup:
+        return obj
     if hasattr(obj, '__html__'):
-        safe_markup = obj.__html__()
-        if ctx == 'tag':
-            return safe_markup
-        else:
-            for k, v in UNSAFE_CHARS_ENTITIES_IN_ATTR:
-                safe_markup = safe_markup.replace(k, v)
-            return safe_markup
-    obj = unicode(obj)
-    for k, v in UNSAFE_CHARS_ENTITIES:
-        obj = obj.replace(k, v)
-    return obj
+        return obj.__html__()
+    return escape_text(unicode(obj))
+
+
+def escape_attr(obj):
+    'Escapes value of expression in tag attribute'
+    cls = obj.__class__
+    if cls is unicode:
+        return escape_text(obj)
+    if cls in NUMBER_TYPES:
+        return unicode(obj)
+    if cls is Markup:
+        return escape_markup_in_attr(obj)
+    if hasattr(obj, '__html__'):
+        return escape_markup_in_attr(obj.__html__())
+    return escape_text(unicode(obj))
+
+
+URL_ATTRS = frozenset(['action', 'background', 'cite', 'codebase', 'formaction',
+                       'href', 'icon', 'longdesc', 'manifest', 'poster', 'src', 'usemap'])
+# url attributes of specific tags
+TAG_URL_ATTRS = {'object': frozenset(['data'])}
+UNSAFE_URL_SCHEMES = frozenset(['javascript', 'vbscript'])
+# browsers ignore whitespace and control chars in url scheme
+URL_IGNORED_CHARS = re.compile(u'[\x00-\x20\x7f]+', re.U)
+
+
+def is_url_attr(tag, attr_name):
+    'True if attribute of tag (None if unknown) contains url'
+    attr_name = attr_name.lower()
+    if attr_name in URL_ATTRS:
+        return True
+    return tag is not None and attr_name in TAG_URL_ATTRS.get(tag.lower(), ())
+
+
+def check_url(value):
+    'Returns "#" instead of escaped url with UNSAFE_URL_SCHEMES'
+    colon = value.find(u':')
+    if colon != -1 and \
+            URL_IGNORED_CHARS.sub(u'', value[:colon]).lower() in UNSAFE_URL_SCHEMES:
+        return u'#'
+    return value
+
+
+def escape_url(obj):
+    '''
+    Escapes value of url attribute made of one expression. Urls with
+    UNSAFE_URL_SCHEMES are replaced by "#" unless they are markup.
+    '''
+    value = escape_attr(obj)
+    if obj.__class__ is not Markup and not hasattr(obj, '__html__'):
+        return check_url(value)
+    return value
+
+
+ESCAPE_FUNCTIONS = {'tag': escape_tag, 'attr': escape_attr, 'url': escape_url}
+
+
+def escape(obj, ctx='tag'):
+    return ESCAPE_FUNCTIONS.get(ctx, escape_attr)(obj)
 
 
 def unescape(obj):
@@ -300,13 +428,29 @@ class WrongToken(Exception): pass
 # variables names (we do not want to override user variables and vise versa)
 TREE_BUILDER = '__MINT_TREE_BUILDER__'
 TREE_FACTORY = '__MINT_TREE_FACTORY__'
+BUFFER_FACTORY = '__MINT_BUFFER_FACTORY__'
 MAIN_FUNCTION = '__MINT_MAIN__'
+GENERATE_FUNCTION = '__MINT_GENERATE__'
 TAG_START = '__MINT_TAG_START__'
 TAG_END = '__MINT_TAG_END__'
 DATA = '__MINT_DATA__'
+PART = '__MINT_PART__'
 ESCAPE_HELLPER = '__MINT_ESCAPE__'
+ESCAPE_ATTR_HELPER = '__MINT_ESCAPE_ATTR__'
+ESCAPE_URL_HELPER = '__MINT_ESCAPE_URL__'
+# escape context -> name of escape function in templates namespace
+ESCAPE_HELPERS = {'tag': ESCAPE_HELLPER, 'attr': ESCAPE_ATTR_HELPER, 'url': ESCAPE_URL_HELPER}
+CHECK_URL_HELPER = '__MINT_CHECK_URL__'
+# tuple of helpers, template functions bind them as local variables
+HELPERS = '__MINT_HELPERS__'
+HELPER_NAMES = (ESCAPE_HELLPER, ESCAPE_ATTR_HELPER, ESCAPE_URL_HELPER, CHECK_URL_HELPER,
+                'utils')
 CURRENT_NODE = '__MINT_CURRENT_NODE__'
 
+# html5 void elements
+SELFCLOSED_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                             'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
 
 ##### MINT NODES
 
@@ -564,46 +708,68 @@ class RecursiveStack(object):
 
 
 class Parser(object):
+    '''
+    States machine. Each state is a sequence of variantes
+    (token or tokens list, new_state, callback) or (parser, new_state, callback).
+    Variantes are compiled to dispatch tables on first use.
+    '''
     def __init__(self, states):
         self.states = dict(states)
+        self._tables = None
+
+    def compile(self):
+        '''
+        Turns each state into (table, fallback) pair, where table maps token to
+        (new_state, callback) and fallback is first sub parser of the state.
+        Earlier variantes take precedence, as in sequential scanning.
+        '''
+        tables = {}
+        for name, variantes in self.states.iteritems():
+            table, fallback = {}, None
+            for variante, state, callback in variantes:
+                # sub parsers may be named to allow forward references
+                if isinstance(variante, basestring):
+                    variante = globals()[variante]
+                if isinstance(variante, Parser):
+                    if fallback is None:
+                        fallback = variante, state, callback
+                    continue
+                if not isinstance(variante, (list, tuple)):
+                    variante = (variante,)
+                for token in variante:
+                    table.setdefault(token, (state, callback))
+            tables[name] = table, fallback
+        self._tables = tables
+        return tables
 
     def parse(self, tokens_stream, stack):
+        tables = self._tables or self.compile()
         current_state = 'start'
-        variantes = self.states[current_state]
+        table, fallback = tables[current_state]
         for tok in tokens_stream:
-            token, tok_value, lineno, pos = tok
+            token = tok[0]
 
             # accept new token
-            new_state = None
-            for item in variantes:
-                variante, state, callback = item
-                # tokens sequence
-                if isinstance(variante, basestring):
-                    variante = globals().get(variante)
-                if isinstance(variante, (list, tuple)):
-                    if token in variante:
-                        new_state = state
-                        break
-                elif variante is token:
-                    new_state = state
-                    break
-                elif isinstance(variante, Parser):
-                    variante.parse(itertools.chain([tok], tokens_stream), stack)
-                    new_state = state
-                    #NOTE: tok still points to first token
-
-            if new_state is None:
+            item = table.get(token)
+            if item is not None:
+                new_state, callback = item
+            elif fallback is not None:
+                parser, new_state, callback = fallback
+                parser.parse(itertools.chain([tok], tokens_stream), stack)
+                #NOTE: tok still points to first token
+            else:
+                token, tok_value, lineno, pos = tok
                 raise WrongToken('[%s] Unexpected token "%s(%r)" at line %d, pos %d' \
                         % (current_state, token, tok_value, lineno, pos))
             # process of new_state
-            elif new_state != current_state:
+            if new_state != current_state:
                 if new_state == 'end':
                     #print current_state, '%s(%r)' % (token, tok_value), new_state
                     callback(tok, stack)
                     #_print_stack(stack)
                     break
                 current_state = new_state
-                variantes = self.states[current_state]
+                table, fallback = tables[current_state]
             # state callback
             #print current_state, '%s(%r)' % (token, tok_value), new_state
             callback(tok, stack)
@@ -976,7 +1142,28 @@ class AstWrapper(object):
         return partial(attr, lineno=self.lineno, col_offset=self.col_offset, ctx=Load())
 
 
+def changes_attrs(nodes):
+    'Checks if mint nodes contain @.attr or @+attr nodes'
+    for node in nodes:
+        if isinstance(node, (SetAttrNode, AppendAttrNode)):
+            return True
+        if changes_attrs(getattr(node, 'body', ())) or changes_attrs(getattr(node, 'orelse', ())):
+            return True
+    return False
+
+
 class MintToPythonTransformer(ast.NodeTransformer):
+    '''
+    Transforms mint tree to python tree.
+
+    By default resulting code builds elements tree (calls of TAG_START,
+    TAG_END and DATA) which is serialized after all. In buffered mode tags are
+    written to output as strings with DATA calls, so attributes of tags can
+    not be changed later with @.attr or @+attr.
+    '''
+
+    def __init__(self, buffered=False):
+        self.buffered = buffered
 
     def visit_MintTemplate(self, node):
         ast_ = AstWrapper(1,1)
@@ -1009,6 +1196,9 @@ class MintToPythonTransformer(ast.NodeTransformer):
 
     def visit_SetAttrNode(self, node):
         ast_ = AstWrapper(node.attr.lineno, node.attr.col_offset)
+        if self.buffered:
+            raise TemplateError('Attributes can not be changed in buffered mode '
+                                '(line %d)' % node.attr.lineno)
         key, value = self.get_value(node.attr, ast_)
         return ast_.Expr(value=ast_.Call(func=ast_.Attribute(value=ast_.Name(id=CURRENT_NODE),
                                                             attr='set'),
@@ -1018,7 +1208,10 @@ class MintToPythonTransformer(ast.NodeTransformer):
 
     def visit_AppendAttrNode(self, node):
         ast_ = AstWrapper(node.attr.lineno, node.attr.col_offset)
-        key, value = self.get_value(node.attr, ast_)
+        if self.buffered:
+            raise TemplateError('Attributes can not be changed in buffered mode '
+                                '(line %d)' % node.attr.lineno)
+        key, value = self.get_value(node.attr, ast_, value_start=False)
         value = ast_.BinOp(
             left=ast_.BoolOp(
                 values=[ast_.Call(
@@ -1038,17 +1231,23 @@ class MintToPythonTransformer(ast.NodeTransformer):
 
     def visit_TagNode(self, node):
         ast_ = AstWrapper(node.lineno, node.col_offset)
+        if self.buffered:
+            return self.buffered_tag(node, ast_)
         name = CURRENT_NODE
         attrs = ast_.Dict(keys=[], values=[])
         for a in node.attrs:
-            k, v = self.get_value(a, ast_)
+            k, v = self.get_value(a, ast_, tag=node.name)
             attrs.keys.append(k)
             attrs.values.append(v)
+        args = [ast_.Str(s=escape(node.name)), attrs]
+        attrs_markup = self.static_attrs_markup(node)
+        if attrs_markup is not None:
+            args.append(ast_.Str(s=attrs_markup))
         nodes = []
         # tag start
         node_start = ast_.Assign(targets=[ast_.Name(id=name, ctx=Store())],
                            value=ast_.Call(func=ast_.Name(id=TAG_START),
-                                           args=[ast_.Str(s=escape(node.name)), attrs],
+                                           args=args,
                                            keywords=[], starargs=None, kwargs=None))
         nodes.append(node_start)
         for n in node.body:
@@ -1065,6 +1264,67 @@ class MintToPythonTransformer(ast.NodeTransformer):
         nodes.append(node_end)
         return nodes
 
+    def static_attrs_markup(self, node):
+        '''
+        Returns serialized attributes of tag, if they have no expressions,
+        else None. Attributes are in lexical order and last value wins as
+        in TreeBuilder.
+        '''
+        attrs = {}
+        for a in node.attrs:
+            if not all(isinstance(n, TextNode) for n in a.value):
+                return None
+            attrs[a.name] = u''.join(unicode(escape(n.text, ctx='attr')) for n in a.value)
+        return u''.join(u' %s="%s"' % (k, attrs[k]) for k in sorted(attrs))
+
+    def buffered_tag(self, node, ast_):
+        tag = escape(node.name)
+        # attributes are serialized in lexical order and last value wins
+        # as in TreeBuilder
+        attrs = dict((a.name, a) for a in node.attrs)
+        pieces = [u'<' + tag]
+        for attr_name in sorted(attrs):
+            pieces.append(u' %s="' % attr_name)
+            pieces.extend(self.attr_pieces(node.name, attrs[attr_name], ast_))
+            pieces.append(u'"')
+        if node.name in SELFCLOSED_TAGS:
+            # void elements have no content, TreeBuilder drops it too
+            pieces.append(u' />')
+            return self.data_calls(pieces, ast_)
+        pieces.append(u'>')
+        nodes = self.data_calls(pieces, ast_)
+        for n in node.body:
+            result = self.visit(n)
+            if isinstance(result, (list, tuple)):
+                for i in result:
+                    nodes.append(i)
+            else:
+                nodes.append(result)
+        nodes.extend(self.data_calls([u'</%s>' % tag], ast_))
+        return nodes
+
+    def data_calls(self, pieces, ast_):
+        '''
+        Returns DATA calls for sequence of strings and python expressions.
+        Strings in a row are joined.
+        '''
+        nodes = []
+        text = []
+        for piece in itertools.chain(pieces, [None]):
+            if isinstance(piece, basestring):
+                text.append(piece)
+                continue
+            if text:
+                nodes.append(ast_.Expr(value=ast_.Call(func=ast_.Name(id=DATA),
+                                                       args=[ast_.Str(s=u''.join(text))],
+                                                       keywords=[], starargs=None, kwargs=None)))
+                text = []
+            if piece is not None:
+                nodes.append(ast_.Expr(value=ast_.Call(func=ast_.Name(id=DATA),
+                                                       args=[piece],
+                                                       keywords=[], starargs=None, kwargs=None)))
+        return nodes
+
     def visit_ForStmtNode(self, node):
         ast_ = AstWrapper(node.lineno, node.col_offset)
         result = []
@@ -1154,32 +1414,104 @@ class MintToPythonTransformer(ast.NodeTransformer):
         return ast_.Expr(value=ast_.Call(func=ast_.Name(id=DATA),
                                          args=[value], keywords=[]))
 
-    def get_value(self, node, ast_, ctx='tag'):
+    def get_value(self, node, ast_, ctx='tag', value_start=True, tag=None):
         if isinstance(node, TextNode):
-            return ast_.Str(s=escape(node.text, ctx=ctx))
+            # escape returns Markup for Markup, but ast needs plain unicode
+            return ast_.Str(s=unicode(escape(node.text, ctx=ctx)))
         elif isinstance(node, ExpressionNode):
             expr = ast.parse(node.text).body[0].value
-            return ast_.Call(func=ast_.Name(id=ESCAPE_HELLPER),
+            return ast_.Call(func=ast_.Name(id=ESCAPE_HELPERS[ctx]),
                              args=[expr],
-                             keywords=[ast.keyword(arg='ctx', value=ast_.Str(s=ctx))], 
-                             starargs=None, kwargs=None)
+                             keywords=[], starargs=None, kwargs=None)
         elif isinstance(node, TagAttrNode):
             key = ast_.Str(s=node.name)
             value = ast_.Str(s=u'')
-            nodes = list(node.value)
-            if nodes:
-                value = ast_.Call(func=ast_.Attribute(value=ast_.Str(s=u''),
-                                                      attr='join'),
-                                  args=[ast_.Tuple(elts=[self.get_value(n, ast_, ctx='attr') for n in nodes])],
-                                  keywords=[], starargs=None, kwargs=None)
+            pieces = self.attr_pieces(tag, node, ast_, value_start=value_start)
+            if pieces:
+                value = self.join_pieces(pieces, ast_)
             return key, value
 
+    def attr_pieces(self, tag, node, ast_, value_start=True):
+        '''
+        Returns escaped static text and python expressions of attribute
+        value. Scheme of url attribute value with expressions is checked
+        at runtime, unless it is set by static text. Appended value
+        (value_start is False) is not at start of url.
+        '''
+        pieces = [unicode(escape(n.text, ctx='attr')) if isinstance(n, TextNode)
+                  else self.get_value(n, ast_, ctx='attr')
+                  for n in node.value]
+        if not value_start or not is_url_attr(tag, node.name):
+            return pieces
+        if len(node.value) == 1 and isinstance(node.value[0], ExpressionNode):
+            # markup value is trusted
+            return [self.get_value(node.value[0], ast_, ctx='url')]
+        for piece in pieces:
+            if not isinstance(piece, unicode):
+                break
+            if u':' in piece:
+                return pieces
+        else:
+            return pieces
+        return [ast_.Call(func=ast_.Name(id=CHECK_URL_HELPER),
+                          args=[self.join_pieces(pieces, ast_)],
+                          keywords=[], starargs=None, kwargs=None)]
+
+    def join_pieces(self, pieces, ast_):
+        'Returns python expression joining strings and expressions'
+        return ast_.Call(func=ast_.Attribute(value=ast_.Str(s=u''), attr='join'),
+                         args=[ast_.Tuple(elts=[ast_.Str(s=p) if isinstance(p, unicode) else p
+                                                for p in pieces])],
+                         keywords=[], starargs=None, kwargs=None)
+
+
+class StaticDataFolder(ast.NodeTransformer):
+    '''
+    Node transformer, joins DATA calls with string literals in a row into one
+    call. Static tags are such calls in buffered mode, so each run of static
+    content is written to output with one call.
+    '''
+    def generic_visit(self, node):
+        ast.NodeTransformer.generic_visit(self, node)
+        for field in ('body', 'orelse'):
+            statements = getattr(node, field, None)
+            if isinstance(statements, list):
+                setattr(node, field, self.fold(statements))
+        return node
+
+    def fold(self, statements):
+        result = []
+        for statement in statements:
+            text = self.static_data(statement)
+            if text is not None and result:
+                last_text = self.static_data(result[-1])
+                if last_text is not None:
+                    result[-1].value.args[0].s = last_text + text
+                    continue
+            result.append(statement)
+        return result
+
+    def static_data(self, node):
+        'Returns string of DATA(string) statement or None'
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+            call = node.value
+            if isinstance(call.func, ast.Name) and call.func.id == DATA and \
+                    len(call.args) == 1 and isinstance(call.args[0], ast.Str):
+                return call.args[0].s
+        return None
+
 
 class SlotsGetter(ast.NodeTransformer):
-    'Node transformer, collects slots'
-    def __init__(self):
+    '''
+    Node transformer, collects slots.
+    Slot functions are renamed to prefix + slot name, so prefix must be unique
+    for each template in inheritance chain.
+    '''
+    def __init__(self, prefix='slot_', factory=TREE_FACTORY):
         self.slots = {}
         self.base = None
+        self.prefix = prefix
+        self.factory = factory
     def visit_FunctionDef(self, node):
         ast_ = AstWrapper(node.lineno, node.col_offset)
         new_tree_call = ast_.Assign(targets=[ast_.Tuple(elts=[
@@ -1188,7 +1520,7 @@ class SlotsGetter(ast.NodeTransformer):
                                                          ast_.Name(id=TAG_END, ctx=Store()),
                                                          ast_.Name(id=DATA, ctx=Store())],
                                                        ctx=Store())],
-                                    value=ast_.Call(func=ast_.Name(id=TREE_FACTORY),
+                                    value=ast_.Call(func=ast_.Name(id=self.factory),
                                                     args=[],
                                                     keywords=[], starargs=None, kwargs=None))
         tree_to_unicode_call = ast_.Return(value=ast_.Call(func=ast_.Attribute(
@@ -1208,11 +1540,187 @@ class SlotsGetter(ast.NodeTransformer):
                 node.body.remove(n)
             return node
         self.slots[node.name] = node
-        node.name = 'slot_' + os.urandom(5).encode('hex')
+        node.name = self.prefix + node.name
     def visit_BaseTemplate(self, node):
         self.base = node.name
 
 
+class DataToYield(ast.NodeTransformer):
+    'Node transformer, replaces DATA calls with yield expressions'
+    def __init__(self):
+        self.yields = 0
+
+    def visit_Expr(self, node):
+        call = node.value
+        if isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id == DATA:
+            self.yields += 1
+            ast_ = AstWrapper(node.lineno, node.col_offset)
+            return ast_.Expr(value=ast_.Yield(value=call.args[0]))
+        return node
+
+
+def make_generator(main):
+    '''
+    Returns generator function made of buffered main function, it yields
+    strings instead of writing them to buffer. Returns None if main function
+    builds elements tree or writes nothing.
+    '''
+    builder_call = main.body[0].value
+    if builder_call.func.id != BUFFER_FACTORY:
+        return None
+    generator = copy.deepcopy(main)
+    generator.name = GENERATE_FUNCTION
+    # without buffer creation and return of its value
+    generator.body = generator.body[1:-1]
+    transformer = DataToYield()
+    transformer.visit(generator)
+    if not transformer.yields:
+        return None
+    return generator
+
+
+def make_slot_generator(slot):
+    '''
+    Returns copy of buffered slot function, which yields strings instead
+    of writing them to own buffer. Returns None for slots building elements
+    tree or writing nothing.
+    '''
+    index = builder_index(slot)
+    if slot.body[index].value.func.id != BUFFER_FACTORY:
+        return None
+    generator = copy.deepcopy(slot)
+    generator.name = 'generate_' + slot.name
+    # without buffer creation and return of its value
+    del generator.body[index]
+    del generator.body[-1]
+    transformer = DataToYield()
+    transformer.visit(generator)
+    if not transformer.yields:
+        return None
+    return generator
+
+
+def builder_index(function):
+    'Returns index of output builder creation statement in function body'
+    for i, statement in enumerate(function.body):
+        if isinstance(statement, ast.Assign) and isinstance(statement.value, ast.Call) and \
+                isinstance(statement.value.func, ast.Name) and \
+                statement.value.func.id in (TREE_FACTORY, BUFFER_FACTORY):
+            return i
+
+
+def make_writer(slot):
+    '''
+    Returns copy of buffered slot function, which takes DATA of caller as
+    first argument and writes to it instead of own buffer. Returns None for
+    slots building elements tree.
+    '''
+    index = builder_index(slot)
+    if slot.body[index].value.func.id != BUFFER_FACTORY:
+        return None
+    writer = copy.deepcopy(slot)
+    writer.name = 'writer_' + slot.name
+    # without buffer creation and return of its value
+    del writer.body[index]
+    del writer.body[-1]
+    if not writer.body:
+        writer.body.append(ast.Pass(lineno=slot.lineno, col_offset=slot.col_offset))
+    writer.args.args.insert(0, ast.Name(id=DATA, ctx=Param(),
+                                        lineno=slot.lineno, col_offset=slot.col_offset))
+    return writer
+
+
+class SlotCallsSplicer(ast.NodeTransformer):
+    '''
+    Node transformer, replaces slot calls of template functions
+    (DATA(slot(...))) with calls of slot writers (writer(DATA, ...)), so
+    slots write directly to output of caller.
+    '''
+    def __init__(self, writers):
+        # slot name -> writer function name
+        self.writers = writers
+        self.local_names = set()
+
+    def visit_FunctionDef(self, node):
+        if node.name == GENERATE_FUNCTION:
+            return node
+        # slot may be shadowed by argument or local variable
+        self.local_names = set(n.id for n in ast.walk(node)
+                               if isinstance(n, ast.Name) and not isinstance(n.ctx, Load))
+        self.generic_visit(node)
+        return node
+
+    def visit_Expr(self, node):
+        call = node.value
+        if isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and \
+                call.func.id == DATA and len(call.args) == 1:
+            slot_call = call.args[0]
+            if isinstance(slot_call, ast.Call) and isinstance(slot_call.func, ast.Name):
+                name = slot_call.func.id
+                if name in self.writers and name not in self.local_names:
+                    ast_ = AstWrapper(node.lineno, node.col_offset)
+                    slot_call.func = ast_.Name(id=self.writers[name])
+                    slot_call.args.insert(0, ast_.Name(id=DATA))
+                    return ast_.Expr(value=slot_call)
+        return node
+
+
+class SlotYieldsSplicer(ast.NodeTransformer):
+    '''
+    Node transformer, replaces yields of slot calls in generator functions
+    (yield slot(...)) with loops over slot generators, so parts of slots
+    are yielded while slots are rendered.
+    '''
+    def __init__(self, generators):
+        # slot name -> generator function name
+        self.generators = generators
+        self.local_names = set()
+
+    def visit_FunctionDef(self, node):
+        # slot may be shadowed by argument or local variable
+        self.local_names = set(n.id for n in ast.walk(node)
+                               if isinstance(n, ast.Name) and not isinstance(n.ctx, Load))
+        self.generic_visit(node)
+        return node
+
+    def visit_Expr(self, node):
+        value = node.value
+        if isinstance(value, ast.Yield) and isinstance(value.value, ast.Call) and \
+                isinstance(value.value.func, ast.Name):
+            slot_call = value.value
+            name = slot_call.func.id
+            if name in self.generators and name not in self.local_names:
+                ast_ = AstWrapper(node.lineno, node.col_offset)
+                slot_call.func = ast_.Name(id=self.generators[name])
+                return ast_.For(target=ast_.Name(id=PART, ctx=Store()),
+                                iter=slot_call,
+                                body=[ast_.Expr(value=ast_.Yield(value=ast_.Name(id=PART)))],
+                                orelse=[])
+        return node
+
+
+def bind_helpers(function):
+    '''
+    Inserts assignments of used helpers from HELPERS tuple to local variables
+    at start of function, so they are not looked up in globals on each use.
+    Helpers shadowed by arguments or local variables are not bound.
+    '''
+    used = set()
+    local_names = set()
+    for n in ast.walk(function):
+        if isinstance(n, ast.Name):
+            if isinstance(n.ctx, Load):
+                used.add(n.id)
+            else:
+                local_names.add(n.id)
+    ast_ = AstWrapper(function.lineno, function.col_offset)
+    for i, name in reversed(list(enumerate(HELPER_NAMES))):
+        if name in used and name not in local_names:
+            function.body.insert(0, ast_.Assign(targets=[ast_.Name(id=name, ctx=Store())],
+                                                value=ast_.Subscript(value=ast_.Name(id=HELPERS),
+                                                                     slice=ast.Index(value=ast_.Num(n=i)))))
+
+
 def _correct_inheritance(new_slots, old_slots):
     slots = {}
     for k, value in new_slots.items():
@@ -1230,6 +1738,17 @@ def _correct_inheritance(new_slots, old_slots):
     return slots
 
 
+def slots_prefix(filename, depth):
+    '''
+    Prefix of slot functions names of template. Depth is the level of template
+    in inheritance chain (0 for the template being compiled), so prefixes never
+    collide in one chain. Name of template makes compiled code readable.
+    '''
+    name = os.path.splitext(os.path.basename(filename))[0]
+    # without re.U non ascii chars are replaced too
+    return 'slot_%d_%s_' % (depth, str(re.sub(r'\W', '_', name)))
+
+
 def get_mint_tree(tokens_stream):
     '''
     This function is wrapper to normal parsers (tag_parser, block_parser, etc.).
@@ -1240,17 +1759,127 @@ def get_mint_tree(tokens_stream):
     return MintTemplate(body=smart_stack.stack)
 
 
+re_leading_whitespace = re.compile(r'\s+', re.U)
+
+
+def shift_lineno(nodes, delta):
+    'Adds delta to line numbers of mint nodes and their children'
+    stack = list(nodes)
+    # else nodes are in body and in orelse of if node
+    seen = set()
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, Node) and id(node) not in seen:
+            seen.add(id(node))
+            if getattr(node, 'lineno', None) is not None:
+                node.lineno += delta
+            stack.extend(v for v in node.__dict__.itervalues()
+                         if isinstance(v, (list, Node)))
+
+
+class IncrementalParser(object):
+    '''
+    Parses new versions of one template, reusing mint nodes of top level
+    blocks which were not changed. Block starts with not indented line,
+    except comments and #elif/#else lines. Nodes of unchanged blocks are
+    shared with trees returned earlier, their line numbers are updated
+    in place.
+    '''
+
+    def __init__(self):
+        # (block source, indention width) -> list of [nodes, first lineno]
+        self._blocks = {}
+
+    def parse(self, source):
+        lines = StringIO(source).readlines()
+        decoded = [line.decode('utf-8') if isinstance(line, str) else line
+                   for line in lines]
+        if any(line.rstrip('\r\n').endswith('\\') for line in decoded):
+            # lines transfer may join blocks
+            self._blocks = {}
+            return get_mint_tree(tokenizer(source))
+        indent = 0
+        starts = [0]
+        # tokenizer takes indention from whitespace after newline or at
+        # start of file
+        newline = False
+        for i, line in enumerate(decoded):
+            if re_comment.match(line):
+                continue
+            match = re_leading_whitespace.match(line.rstrip('\r\n'))
+            if match:
+                if not indent and (newline or i == 0):
+                    indent = len(match.group())
+            elif i and line.strip() and not TOKEN_STATEMENT_ELIF.regex.match(line) \
+                    and not TOKEN_STATEMENT_ELSE.regex.match(line):
+                starts.append(i)
+            newline = True
+        starts.append(len(lines))
+        old_blocks, self._blocks = self._blocks, {}
+        body = []
+        for start, end in zip(starts, starts[1:]):
+            key = ''.join(lines[start:end]), indent
+            entries = old_blocks.get(key)
+            if entries:
+                entry = entries.pop()
+                if entry[1] != start + 1:
+                    shift_lineno(entry[0], start + 1 - entry[1])
+                    entry[1] = start + 1
+            else:
+                try:
+                    nodes = get_mint_tree(indent_tokenizer(
+                        base_tokenizer(key[0]), indent)).body
+                except (WrongToken, SyntaxError, StopIteration):
+                    # full parse reports right line numbers
+                    self._blocks = {}
+                    return get_mint_tree(tokenizer(source))
+                shift_lineno(nodes, start)
+                entry = [nodes, start + 1]
+            self._blocks.setdefault(key, []).append(entry)
+            body.extend(entry[0])
+        return MintTemplate(body=body)
+
+
 ############# API
 class TemplateNotFound(Exception):
     pass
 
 
+class MintElement(Element):
+    '''
+    Element with serialized attributes precomputed by compiler for tags
+    without expressions in attributes. Changing of attributes drops them.
+    '''
+    attrs_markup = None
+
+    def set(self, key, value):
+        self.attrs_markup = None
+        Element.set(self, key, value)
+
+
+def attrs_to_unicode(node):
+    'Serialized attributes of element in lexical order'
+    markup = node.attrs_markup
+    if markup is None:
+        items = node.items()
+        items.sort()
+        markup = u''.join([u' %s="%s"' % item for item in items])
+    return markup
+
+
 class TreeBuilder(_TreeBuilder):
     'Tree with root element already set'
-    def __init__(self, *args, **kwargs):
-        _TreeBuilder.__init__(self, *args, **kwargs)
+    def __init__(self, element_factory=MintElement):
+        _TreeBuilder.__init__(self, element_factory)
         self.start('root', {})
 
+    def start(self, tag, attrs, attrs_markup=None):
+        element = _TreeBuilder.start(self, tag, attrs)
+        element.attrs_markup = attrs_markup
+        return element
+
     def to_unicode(self):
         class dummy: pass
         data = []
@@ -1269,33 +1898,38 @@ class TreeBuilder(_TreeBuilder):
 
     def _node_to_unicode(self, out, node):
         #NOTE: all data must be escaped during tree building
-        tag = node.tag
-        items = node.items()
-        selfclosed = ['link', 'input', 'br', 'hr', 'img', 'meta']
-        out.write(u'<' + tag)
-        if items:
-            items.sort() # lexical order
-            for k, v in items:
-                out.write(u' %s="%s"' % (k, v))
-        if tag in selfclosed:
-            out.write(u' />')
-        else:
-            out.write(u'>')
-            if node.text or len(node):
-                if node.text:
-                    out.write(node.text)
-                for n in node:
-                    self._node_to_unicode(out, n)
-            out.write(u'</' + tag + '>')
-            if node.tail:
-                out.write(node.tail)
-
-
-class PprintTreeBuilder(_TreeBuilder):
+        write = out.write
+        # elements to serialize and end strings of started elements, so
+        # nesting depth does not use python stack
+        stack = [node]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            node = pop()
+            if node.__class__ is unicode:
+                write(node)
+                continue
+            tag = node.tag
+            markup = node.attrs_markup
+            if markup is None:
+                markup = attrs_to_unicode(node)
+            if tag in SELFCLOSED_TAGS:
+                write(u'<%s%s />' % (tag, markup))
+                if node.tail:
+                    write(node.tail)
+                continue
+            write(u'<%s%s>' % (tag, markup))
+            if node.text:
+                write(node.text)
+            push(u'</%s>%s' % (tag, node.tail or u''))
+            if len(node):
+                stack.extend(reversed(node))
+
+
+class PprintTreeBuilder(TreeBuilder):
     'Tree with root element already set'
-    def __init__(self, *args, **kwargs):
-        _TreeBuilder.__init__(self, *args, **kwargs)
-        self.start('root', {})
+    def __init__(self, element_factory=MintElement):
+        TreeBuilder.__init__(self, element_factory)
         self._level = -1
 
     @property
@@ -1321,50 +1955,58 @@ class PprintTreeBuilder(_TreeBuilder):
 
     def _node_to_unicode(self, out, node):
         #NOTE: all data must be escaped during tree building
-        self.indent()
-        tag = node.tag
-        items = node.items()
-        selfclosed = ['link', 'input', 'br', 'hr', 'img', 'meta']
-        children = list(node)
-        text = node.text
-        tail = node.tail
-        out.write(self.indention)
-        out.write(u'<' + tag)
-        if items:
-            items.sort() # lexical order
-            for k, v in items:
-                out.write(u' %s="%s"' % (k, v))
-        if tag in selfclosed:
-            out.write(u' />')
-        else:
-            out.write(u'>')
-            if text:
-                if text.endswith('\n'):
-                    text = text[:-1]
-                self.indent()
-                out.write('\n')
-                out.write(self.indent_text(text))
-                out.write('\n')
-                self.unindent()
-            if children:
-                out.write('\n')
-                for n in children:
-                    self._node_to_unicode(out, n)
-
-            if children or text:
-                out.write(self.indention)
-            out.write(u'</' + tag + '>')
-            if node.tail:
-                out.write('\n')
-                tail = node.tail
+        write = out.write
+        indent_text = self.indent_text
+        level = self._level
+        # elements to serialize and (element, has content) pairs of started
+        # elements, so nesting depth does not use python stack
+        stack = [node]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            node = pop()
+            if node.__class__ is tuple:
+                node, has_content = node
+                if has_content:
+                    write('  ' * level)
+                write(u'</%s>' % node.tag)
+            else:
+                level += 1
+                tag = node.tag
+                markup = node.attrs_markup
+                if markup is None:
+                    markup = attrs_to_unicode(node)
+                if tag in SELFCLOSED_TAGS:
+                    write(u'%s<%s%s />' % ('  ' * level, tag, markup))
+                else:
+                    write(u'%s<%s%s>' % ('  ' * level, tag, markup))
+                    text = node.text
+                    if text:
+                        if text.endswith('\n'):
+                            text = text[:-1]
+                        write('\n')
+                        write(indent_text(text, '  ' * (level + 1)))
+                        write('\n')
+                    has_children = len(node)
+                    push((node, bool(has_children or text)))
+                    if has_children:
+                        write('\n')
+                        stack.extend(reversed(node))
+                    continue
+            # element is closed
+            tail = node.tail
+            if tail:
+                write('\n')
                 if tail.endswith('\n'):
                     tail = tail[:-1]
-                out.write(self.indent_text(tail))
-        out.write('\n')
-        self.unindent()
+                write(indent_text(tail, '  ' * level))
+            write('\n')
+            level -= 1
 
-    def indent_text(self, text):
-        return '\n'.join([self.indention+t for t in text.split('\n')])
+    def indent_text(self, text, indention=None):
+        if indention is None:
+            indention = self.indention
+        return '\n'.join([indention + t for t in text.split('\n')])
 
     def indent(self):
         self._level += 1
@@ -1372,6 +2014,21 @@ class PprintTreeBuilder(_TreeBuilder):
         self._level -= 1
 
 
+class StringBuilder(object):
+    'Collects already escaped strings of template output'
+    def __init__(self):
+        self._data = []
+        self.data = self._data.append
+
+    def to_unicode(self):
+        return Markup(u''.join(self._data))
+
+
+def new_buffer():
+    builder = StringBuilder()
+    return builder, None, None, builder.data
+
+
 def new_tree(pprint):
     def wrapper():
         tree = pprint and PprintTreeBuilder() or TreeBuilder()
@@ -1381,21 +2038,43 @@ def new_tree(pprint):
 
 class Template(object):
 
-    def __init__(self, source, filename=None, loader=None, globals=None, pprint=False):
+    def __init__(self, source, filename=None, loader=None, globals=None, pprint=False,
+                 code=None, bases=None):
         assert source or filename, 'Please provide source code or filename'
         self.source = source
         self.filename = filename if filename else '<string>'
         self._loader = loader
-        self.compiled_code = compile(self.tree(), self.filename, 'exec')
         self.globals = globals or {}
         self.pprint = pprint
-
-    def tree(self, slots=None):
+        # names of base templates, nearest first
+        self.bases = bases or ()
+        if code is None:
+            code = compile(self.tree(), self.filename, 'exec')
+        self.compiled_code = code
+        self._functions = self.module_functions()
+
+    def mint_tree(self):
+        '''
+        Returns parsed template. Parsing results are shared by loader, so
+        mint tree must not be changed.
+        '''
+        parse = getattr(self._loader, 'parse', None)
+        if parse is not None:
+            return parse(self.filename, self.source or None)
+        if self.source:
+            return get_mint_tree(tokenizer(self.source))
+        with open(self.filename, 'rb') as f:
+            return get_mint_tree(tokenizer(f))
+
+    def tree(self, slots=None, depth=0):
         slots = slots or {}
-        source = StringIO(self.source) if self.source else open(self.filename, 'r')
-        mint_tree = get_mint_tree(tokenizer(source))
-        tree = MintToPythonTransformer().visit(mint_tree)
-        slots_getter = SlotsGetter()
+        mint_tree = self.mint_tree()
+        # pretty printing and changing of attributes need elements tree
+        buffered = not self.pprint and not changes_attrs(mint_tree.body)
+        tree = MintToPythonTransformer(buffered=buffered).visit(mint_tree)
+        tree = StaticDataFolder().visit(tree)
+        slots_getter = SlotsGetter(slots_prefix(self.filename, depth),
+                                   factory=BUFFER_FACTORY if buffered else TREE_FACTORY)
         slots_getter.visit(tree.body[0])
         _slots, base_template_name = slots_getter.slots, slots_getter.base
         # we do not want to override slot's names,
@@ -1403,43 +2082,434 @@ class Template(object):
         slots = _correct_inheritance(slots, _slots)
         if base_template_name:
             base_template = self._loader.get_template(base_template_name)
-            tree = base_template.tree(slots=slots)
+            self.bases = (base_template_name,) + tuple(base_template.bases)
+            tree = base_template.tree(slots=slots, depth=depth + 1)
         elif slots is not None:
             # insert implementation of slots
-            # def slot_bb13e100d5(): ...
+            # def slot_0_index_content(): ...
             # and insert assings of slots
-            # real_slot_name = slot_bb13e100d5
+            # content = slot_0_index_content
             for k,v in slots.items():
                 if not k.endswith('__overrided'):
                     ast_ = AstWrapper(v.lineno, v.col_offset)
                     tree.body.insert(0, ast_.Assign(targets=[ast_.Name(id=k, ctx=Store())],
                                                      value=ast_.Name(id=v.name)))
                 tree.body.insert(0, v)
+            generator = make_generator(tree.body[-1])
+            writers = {}
+            generators = {}
+            slot_generators = []
+            for k, v in slots.items():
+                if not k.endswith('__overrided'):
+                    writer = make_writer(v)
+                    if writer is not None:
+                        writers[k] = writer.name
+                        tree.body.insert(0, writer)
+                    if generator is not None:
+                        slot_generator = make_slot_generator(v)
+                        if slot_generator is not None:
+                            generators[k] = slot_generator.name
+                            slot_generators.append(slot_generator)
+            SlotCallsSplicer(writers).visit(tree)
+            if generator is not None:
+                # slots are rendered by parts too
+                splicer = SlotYieldsSplicer(generators)
+                for function in slot_generators + [generator]:
+                    splicer.visit(function)
+                tree.body[0:0] = slot_generators
+                tree.body.append(generator)
+            for statement in tree.body:
+                if isinstance(statement, ast.FunctionDef):
+                    bind_helpers(statement)
         # tree already has slots definitions and ready to be compiled
         return tree
 
     def render(self, **kwargs):
-        ns = {
-            'utils':utils,
-            ESCAPE_HELLPER:escape,
-            TREE_FACTORY:new_tree(self.pprint),
-        }
-        ns.update(self.globals)
-        ns.update(kwargs)
-        exec self.compiled_code in ns
         # execute template main function
-        return ns[MAIN_FUNCTION]()
+        return self.namespace(kwargs)[MAIN_FUNCTION]()
+
+    def generate(self, **kwargs):
+        '''
+        Returns iterator of rendered template parts. Template is rendered
+        while iterating. Templates with elements tree are rendered at once.
+        '''
+        ns = self.namespace(kwargs)
+        generate = ns.get(GENERATE_FUNCTION)
+        if generate is None:
+            return iter([ns[MAIN_FUNCTION]()])
+        return generate()
+
+    def stream(self, buffer_size=4096, **kwargs):
+        '''
+        Returns TemplateStream of encoded chunks, suitable for WSGI response.
+        Chunks have at least buffer_size chars.
+        '''
+        return TemplateStream(self.generate(**kwargs), buffer_size=buffer_size)
 
     def slot(self, name, **kwargs):
+        return self.namespace(kwargs)[name]
+
+    def namespace(self, kwargs):
+        '''
+        Returns globals of template functions for one rendering
+        '''
         ns = {
+            '__builtins__':__builtin__,
             'utils':utils,
-            ESCAPE_HELLPER:escape,
+            ESCAPE_HELLPER:escape_tag,
+            ESCAPE_ATTR_HELPER:escape_attr,
+            ESCAPE_URL_HELPER:escape_url,
+            CHECK_URL_HELPER:check_url,
             TREE_FACTORY:new_tree(self.pprint),
+            BUFFER_FACTORY:new_buffer,
         }
         ns.update(self.globals)
         ns.update(kwargs)
-        exec self.compiled_code in ns
-        return ns[name]
+        ns[HELPERS] = tuple(ns[name] for name in HELPER_NAMES)
+        functions = self._functions
+        if functions is None:
+            exec self.compiled_code in ns
+            return ns
+        # module body was executed once, so we only bind functions to new globals
+        bound = {}
+        for name, function in functions:
+            new_function = bound.get(function)
+            if new_function is None:
+                new_function = bound[function] = FunctionType(function.func_code, ns,
+                                                              function.func_name,
+                                                              function.func_defaults,
+                                                              function.func_closure)
+            ns[name] = new_function
+        return ns
+
+    def module_functions(self):
+        '''
+        Returns (name, function) pairs defined by module body of compiled
+        template or None if module body depends on rendering globals (slots
+        default arguments for example) or slots have mutable default
+        arguments, so module body must be executed for each rendering.
+        '''
+        ns = {}
+        try:
+            exec self.compiled_code in ns
+        except Exception:
+            return None
+        if not set(self.compiled_code.co_names).issubset(ns):
+            return None
+        functions = [(k, v) for k, v in ns.iteritems() if isinstance(v, FunctionType)]
+        for name, function in functions:
+            if not all(map(is_immutable, function.func_defaults or ())):
+                return None
+        return functions
+
+
+IMMUTABLE_TYPES = (type(None), bool, int, long, float, complex, str, unicode)
+
+
+def is_immutable(value):
+    '''
+    True if value can not keep state between renderings, so it is safe
+    to share it as slot default argument
+    '''
+    if type(value) in (tuple, frozenset):
+        return all(map(is_immutable, value))
+    return type(value) in IMMUTABLE_TYPES
+
+
+class TemplateStream(object):
+    '''
+    Iterable of encoded chunks of rendered template. Parts of template are
+    joined in chunks of at least buffer_size chars (if 0 every part is a
+    chunk). First part is sent at once, so client gets head of page while
+    the rest is rendered.
+    '''
+
+    def __init__(self, gen, buffer_size=4096, encoding='utf-8'):
+        self._gen = gen
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+
+    def __iter__(self):
+        encoding = self.encoding
+        buffer_size = self.buffer_size
+        buf = []
+        size = 0
+        gen = iter(self._gen)
+        for part in gen:
+            yield part.encode(encoding)
+            break
+        for part in gen:
+            buf.append(part)
+            size += len(part)
+            if size >= buffer_size:
+                yield u''.join(buf).encode(encoding)
+                buf = []
+                size = 0
+        if buf:
+            yield u''.join(buf).encode(encoding)
+
+
+def source_hash(source):
+    return hashlib.sha1(source).hexdigest()
+
+
+def map_file(filename):
+    '''
+    Returns read only memory map of file content (empty string for empty
+    file, it can not be mapped). Map must be closed by caller.
+    '''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def close_map(data):
+    'Closes memory map returned by map_file'
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+
+def file_hash(filename):
+    '''
+    Returns the same hash as source_hash of file content. File is mapped
+    to memory, so content is not copied into a string.
+    '''
+    data = map_file(filename)
+    try:
+        return source_hash(data)
+    finally:
+        close_map(data)
+
+
+def normalize_name(name):
+    'Returns normalized template name, None for None'
+    if name is None:
+        return None
+    return os.path.normpath(name).replace(os.sep, '/')
+
+
+def base_template_name(source):
+    '''
+    Returns name of base template from "#base: " line of template source
+    (string or iterable of lines without line ends) or None. Does not parse
+    the whole template.
+    '''
+    lines = source.splitlines() if isinstance(source, basestring) else source
+    for line in lines:
+        match = TOKEN_BASE_TEMPLATE.regex.match(line)
+        if match:
+            return line[match.end():]
+    return None
+
+
+class DependencyGraph(object):
+    '''
+    Inheritance of templates. bases maps template name to name of its base
+    template (or None), children maps base template name to set of names of
+    templates inheriting it directly.
+    '''
+
+    def __init__(self, bases):
+        self.bases = bases
+        self.children = {}
+        for name, base in bases.iteritems():
+            if base is not None:
+                self.children.setdefault(base, set()).add(name)
+
+    def update(self, template, base):
+        'Sets name of base template of template (None if it has no base)'
+        template, base = normalize_name(template), normalize_name(base)
+        self.remove(template)
+        self.bases[template] = base
+        if base is not None:
+            self.children.setdefault(base, set()).add(template)
+
+    def remove(self, template):
+        'Removes template, templates inheriting it are kept'
+        template = normalize_name(template)
+        if template not in self.bases:
+            return
+        base = self.bases.pop(template)
+        children = self.children.get(base)
+        if children is not None:
+            children.discard(template)
+            if not children:
+                del self.children[base]
+
+    def descendants(self, template):
+        'Sorted names of templates inheriting template directly or through others'
+        found = set()
+        stack = [template]
+        while stack:
+            for child in self.children.get(stack.pop(), ()):
+                if child not in found and child != template:
+                    found.add(child)
+                    stack.append(child)
+        return sorted(found)
+
+    def levels(self):
+        '''
+        Splits templates to lists of templates which do not depend on each
+        other, base templates go first
+        '''
+        bases = dict(self.bases)
+        levels = []
+        done = set()
+        while bases:
+            level = [name for name, base in bases.items()
+                     if base not in bases or base in done]
+            if not level:
+                # inheritance cycle, compilation will report it
+                level = bases.keys()
+            for name in level:
+                del bases[name]
+            done.update(level)
+            levels.append(sorted(level))
+        return levels
+
+
+class BytecodeCache(object):
+    '''
+    Stores compiled templates in directory between processes.
+
+    Entry is marshaled pair (bases, code), where bases are names and source
+    hashes of base templates. Entry file name is hash of template name and
+    source, pprint flag, mint, generated code and python versions. Entry is
+    valid only while sources of all base templates are unchanged.
+    '''
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def filename(self, name, source, pprint=False):
+        key = hashlib.sha1()
+        for part in (__version__, str(CODE_VERSION), sys.version, name,
+                     str(bool(pprint)), source):
+            key.update(part)
+            key.update('\0')
+        return os.path.join(self.directory, key.hexdigest() + '.mintc')
+
+    def load(self, loader, name, source):
+        '''
+        Returns (bases, code) pair or None if there is no valid entry
+        '''
+        try:
+            with open(self.filename(name, source, loader.pprint), 'rb') as f:
+                bases, code = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        for base_name, base_hash in bases:
+            try:
+                if loader.source_hash(base_name) != base_hash:
+                    return None
+            except TemplateNotFound:
+                return None
+        return tuple(base_name for base_name, base_hash in bases), code
+
+    def dump(self, loader, name, source, template):
+        bases = tuple((base_name, loader.source_hash(base_name))
+                      for base_name in template.bases)
+        # write to temporary file and rename to not leave broken entries
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump((bases, template.compiled_code), f)
+            os.rename(tmp, self.filename(name, source, loader.pprint))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def template_size(template):
+    '''
+    Approximate size of template in memory: compiled code and source if
+    template keeps it (templates of Loader keep it only in incremental mode)
+    '''
+    return len(template.source or '') + len(marshal.dumps(template.compiled_code))
+
+
+class LRUCache(object):
+    '''
+    Templates cache, evicts least recently used templates. Limits number of
+    templates (max_entries) and their approximate size in bytes (max_size,
+    see template_size), None means no limit. on_evict(key, template) is called for each evicted
+    template, Loader sets it to drop its data of evicted template.
+    '''
+
+    def __init__(self, max_entries=None, max_size=None, on_evict=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (template, size)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            # most recently used goes to the end
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def __setitem__(self, key, template):
+        size = template_size(template)
+        with self._lock:
+            old_item = self._data.pop(key, None)
+            if old_item is not None:
+                self.size -= old_item[1]
+            self._data[key] = (template, size)
+            self.size += size
+            evicted = self._evict()
+        # callback is called without lock, it may use cache
+        if self.on_evict is not None:
+            for key, template in evicted:
+                self.on_evict(key, template)
+
+    def _evict(self):
+        'Evicts templates over limits, returns list of (key, template) pairs'
+        data = self._data
+        evicted = []
+        while data and (self.max_entries is not None and len(data) > self.max_entries or
+                        self.max_size is not None and self.size > self.max_size):
+            key, (template, size) = data.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            evicted.append((key, template))
+        return evicted
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            self.size -= item[1]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return dict(entries=len(self._data), size=self.size, hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
 
 
 class Loader(object):
@@ -1449,28 +2519,345 @@ class Loader(object):
         # dirs - list of directories. Order matters
         for d in dirs:
             self.dirs.append(os.path.abspath(d))
-        self.cache = kwargs.get('cache', False)
-        self._templates_cache = {}
+        # cache - flag or cache object (LRUCache for example)
+        cache = kwargs.get('cache', False)
+        if isinstance(cache, (bool, int)):
+            self.cache = bool(cache)
+            self._templates_cache = {}
+        else:
+            self.cache = True
+            self._templates_cache = cache
+            if getattr(cache, 'on_evict', False) is None:
+                cache.on_evict = self._evicted
         self.globals = kwargs.get('globals', {})
         self.pprint = kwargs.get('pprint', 0)
-
-    def get_template(self, template):
-        if template in self._templates_cache:
-            return self._templates_cache[template]
+        # bytecode_cache - directory or object with load and dump methods
+        self.bytecode_cache = kwargs.get('bytecode_cache')
+        if isinstance(self.bytecode_cache, basestring):
+            self.bytecode_cache = BytecodeCache(self.bytecode_cache)
+        # auto_reload - recompile cached templates if template or one of its
+        # base templates was modified. Files are checked not often than once
+        # in check_interval seconds.
+        self.auto_reload = kwargs.get('auto_reload', False)
+        self.check_interval = kwargs.get('check_interval', 1)
+        # template name -> [last check time, ((location, mtime), ...)]
+        self._mtimes = {}
+        # location -> (source hash, mint tree), entries of templates removed
+        # from templates cache are dropped
+        self._parsed = {}
+        # incremental - reparse only changed blocks of modified templates
+        self.incremental = kwargs.get('incremental', False)
+        # location -> IncrementalParser
+        self._parsers = {}
+        # pattern -> DependencyGraph of templates matching pattern
+        self._graphs = {}
+        # DependencyGraph of compiled templates
+        self._graph = DependencyGraph({})
+        # template name -> lock of template compilation
+        self._compile_locks = {}
+        self._lock = threading.Lock()
+
+    def find(self, template):
+        '''
+        Returns location of template file
+        '''
         for dir in self.dirs:
-            location = os.path.join(dir, template)
+            # "./name" and "name" have one location
+            location = os.path.normpath(os.path.join(dir, template))
             if os.path.exists(location) and os.path.isfile(location):
-                with open(location, 'r') as f:
-                    tmpl = Template(source=f.read(), filename=f.name,
-                                    loader=self, globals=self.globals, pprint=self.pprint)
-                    if self.cache:
-                        self._templates_cache[template] = tmpl
-                    return tmpl
+                return location
         raise TemplateNotFound(template)
 
+    def parse(self, location, source=None):
+        '''
+        Returns mint tree of template source (string or memory map), file
+        of location is mapped to memory if source is None. Parse results are
+        stored by source hash, so base templates are parsed once for all
+        templates inheriting them.
+        '''
+        if source is None:
+            data = map_file(location)
+            try:
+                return self.parse(location, data)
+            finally:
+                close_map(data)
+        # tokenizer decodes strings and memory maps from utf-8
+        key = source_hash(source.encode('utf-8') if isinstance(source, unicode) else source)
+        parsed = self._parsed.get(location)
+        if parsed is not None and parsed[0] == key:
+            return parsed[1]
+        if self.incremental:
+            parser = self._parsers.get(location)
+            if parser is None:
+                parser = self._parsers[location] = IncrementalParser()
+            # incremental parser needs source string
+            mint_tree = parser.parse(source if isinstance(source, basestring) else source[:])
+        else:
+            mint_tree = get_mint_tree(tokenizer(source))
+        self._parsed[location] = key, mint_tree
+        return mint_tree
+
+    def source_hash(self, template):
+        return file_hash(self.find(template))
+
+    def list_templates(self, pattern='*.mint'):
+        '''
+        Returns sorted names of templates matching pattern. Template
+        from first directory wins if there are templates with the same name.
+        '''
+        names = set()
+        for dir in self.dirs:
+            for root, dirs, files in os.walk(dir):
+                for basename in fnmatch.filter(files, pattern):
+                    name = os.path.relpath(os.path.join(root, basename), dir)
+                    names.add(name.replace(os.sep, '/'))
+        return sorted(names)
+
+    def precompile(self, pattern='*.mint', workers=None):
+        '''
+        Compiles all templates matching pattern in pool of worker processes
+        (number of CPUs by default) and puts them to templates cache and
+        bytecode cache. Base templates are compiled before templates
+        inheriting them. Returns names of compiled templates.
+        '''
+        names = self.list_templates(pattern)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers <= 1:
+            for name in names:
+                self.get_template(name)
+            return names
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (self.dirs, self.pprint, self.bytecode_cache))
+        try:
+            for level in self.dependency_graph(pattern).levels():
+                if self.cache:
+                    level = [name for name in level
+                             if self._cached_template(name) is None]
+                for name, bases, code in pool.map(_precompile_worker, level):
+                    self._compile_template(name, (bases, marshal.loads(code)))
+        finally:
+            pool.close()
+            pool.join()
+        return names
+
+    def get_base(self, template):
+        '''
+        Returns name of base template of template or None. Template is not
+        parsed, only "#base: " line is searched.
+        '''
+        # lines are read until "#base: " line
+        with open(self.find(template), 'rb') as f:
+            return normalize_name(base_template_name(line.rstrip('\r\n') for line in f))
+
+    def dependency_graph(self, pattern='*.mint'):
+        '''
+        Returns DependencyGraph of templates matching pattern. Templates are
+        scanned on first call, then graph is updated when templates are
+        compiled or invalidated.
+        '''
+        with self._lock:
+            graph = self._graphs.get(pattern)
+        if graph is None:
+            graph = DependencyGraph(dict((name, self.get_base(name))
+                                         for name in self.list_templates(pattern)))
+            with self._lock:
+                graph = self._graphs.setdefault(pattern, graph)
+        return graph
+
+    def invalidate(self, template):
+        '''
+        Removes template and compiled templates inheriting it from templates
+        cache, so they are compiled again on next get_template call. Only
+        "#base: " line of template is read to update dependency graphs.
+        Returns names of removed templates.
+        '''
+        with self._lock:
+            names = [template] + self._graph.descendants(normalize_name(template))
+        for name in names:
+            self._uncache(name)
+        try:
+            base = self.get_base(template)
+        except TemplateNotFound:
+            self._update_graphs(template, removed=True)
+        else:
+            self._update_graphs(template, base)
+        return names
+
+    def _update_graphs(self, template, base=None, removed=False):
+        'Sets base template of template in dependency graphs'
+        template = normalize_name(template)
+        basename = template.rsplit('/', 1)[-1]
+        with self._lock:
+            graphs = [self._graph] + [graph for pattern, graph in self._graphs.iteritems()
+                                      if fnmatch.fnmatch(basename, pattern)]
+            for graph in graphs:
+                if removed:
+                    graph.remove(template)
+                else:
+                    graph.update(template, base)
+
+    def export(self, directory, pattern='*.mint'):
+        '''
+        Compiles templates matching pattern to python package in directory,
+        one module per template. Exported templates are loaded by
+        PackageLoader without parsing and compiling. Returns names of
+        exported templates.
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        modules = {}
+        for name in self.list_templates(pattern):
+            template = self.get_template(name)
+            module = base_module = 'template_' + re.sub(r'\W', '_', name)
+            i = 1
+            while module in modules.values():
+                module = '%s_%d' % (base_module, i)
+                i += 1
+            modules[name] = module
+            with open(os.path.join(directory, module + '.py'), 'w') as f:
+                f.write(EXPORTED_TEMPLATE % dict(
+                    name=name, version=__version__, bases=tuple(template.bases),
+                    code=marshal.dumps(template.compiled_code)))
+        with open(os.path.join(directory, '__init__.py'), 'w') as f:
+            f.write(EXPORTED_PACKAGE % dict(version=__version__, magic=imp.get_magic(),
+                                            code_version=CODE_VERSION,
+                                            pprint=bool(self.pprint), templates=modules))
+        return sorted(modules)
+
+    def get_template(self, template):
+        # hot path without locks
+        tmpl = self._cached_template(template)
+        if tmpl is not None:
+            return tmpl
+        if not self.cache:
+            return self._compile_template(template)
+        # only one thread compiles template, others wait for result
+        with self._lock:
+            lock = self._compile_locks.get(template)
+            if lock is None:
+                lock = self._compile_locks[template] = threading.RLock()
+        with lock:
+            tmpl = None
+            # template could be compiled while we were waiting
+            if template in self._templates_cache:
+                tmpl = self._cached_template(template)
+            if tmpl is None:
+                tmpl = self._compile_template(template)
+            with self._lock:
+                self._compile_locks.pop(template, None)
+        return tmpl
+
+    def _cached_template(self, template):
+        'Returns cached template or None if there is no one or it is modified'
+        tmpl = self._templates_cache.get(template)
+        if tmpl is not None:
+            if not self.auto_reload or not self._modified(template):
+                return tmpl
+            # base templates may be cached and not checked yet
+            for name in (template,) + tuple(tmpl.bases):
+                self._uncache(name)
+        return None
+
+    def _evicted(self, template, tmpl):
+        'Drops data of template evicted from templates cache'
+        self._mtimes.pop(template, None)
+        self._parsed.pop(tmpl.filename, None)
+        self._parsers.pop(tmpl.filename, None)
+
+    def _uncache(self, template):
+        '''
+        Removes template from templates cache with its modification times
+        and parse result. Incremental parser is kept to reuse blocks of
+        modified template.
+        '''
+        tmpl = self._templates_cache.pop(template, None)
+        self._mtimes.pop(template, None)
+        if tmpl is not None:
+            self._parsed.pop(tmpl.filename, None)
+
+    def _compile_template(self, template, compiled=None):
+        location = self.find(template)
+        mtime = os.stat(location).st_mtime
+        if self.incremental:
+            # incremental parser needs source string
+            with open(location, 'rb') as f:
+                tmpl = self._load_template(template, location, f.read(), compiled)
+        else:
+            # template is compiled from memory mapped file and does not keep
+            # source, it is parsed from file again if it is a base template
+            source = map_file(location)
+            try:
+                tmpl = self._load_template(template, location, source, compiled)
+            finally:
+                close_map(source)
+            tmpl.source = None
+        self._update_graphs(template, normalize_name(tmpl.bases[0] if tmpl.bases else None))
+        if self.cache:
+            if self.auto_reload:
+                mtimes = [(location, mtime)]
+                for name in tmpl.bases:
+                    base_location = self.find(name)
+                    mtimes.append((base_location, os.stat(base_location).st_mtime))
+                self._mtimes[template] = [time.time(), tuple(mtimes)]
+            self._templates_cache[template] = tmpl
+        return tmpl
+
+    def _modified(self, template):
+        '''
+        Checks if template or its base templates were modified since
+        compilation. Returns False if last check was less than
+        check_interval seconds ago.
+        '''
+        checked = self._mtimes.get(template)
+        if checked is None:
+            return True
+        now = time.time()
+        if now - checked[0] < self.check_interval:
+            return False
+        checked[0] = now
+        for location, mtime in checked[1]:
+            try:
+                if os.stat(location).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _load_template(self, template, location, source, compiled=None):
+        '''
+        Creates template object, takes compiled code from bytecode cache if
+        there is valid entry. compiled - (bases, code) of template compiled
+        by precompile worker, it is already stored in bytecode cache.
+        '''
+        bytecode_cache = self.bytecode_cache
+        code = bases = None
+        if compiled is not None:
+            bases, code = compiled
+            bytecode_cache = None
+        elif bytecode_cache is not None:
+            entry = bytecode_cache.load(self, template, source)
+            if entry is not None:
+                bases, code = entry
+        tmpl = Template(source=source, filename=location, loader=self,
+                        globals=self.globals, pprint=self.pprint,
+                        code=code, bases=bases)
+        if code is None and bytecode_cache is not None:
+            bytecode_cache.dump(self, template, source, tmpl)
+        return tmpl
+
     def __add__(self, other):
         dirs = self.dirs + other.dirs
-        return self.__class__(cache=self.cache, globals=self.globals,*dirs)
+        cache = self.cache
+        if isinstance(self._templates_cache, LRUCache):
+            # new cache with the same limits, on_evict is bound to this loader
+            cache = LRUCache(max_entries=self._templates_cache.max_entries,
+                             max_size=self._templates_cache.max_size)
+        return self.__class__(cache=cache, globals=self.globals, pprint=self.pprint,
+                              bytecode_cache=self.bytecode_cache,
+                              auto_reload=self.auto_reload,
+                              check_interval=self.check_interval,
+                              incremental=self.incremental, *dirs)
 
 
 #NOTE: Taken from jinja2
@@ -1653,6 +3040,14 @@ class Printer(ast.NodeVisitor):
     def visit_Num(self, node):
         self.src.write('%d' % node.n)
 
+    def visit_Yield(self, node):
+        self.make_tab()
+        self.src.write('yield ')
+        self._in_args = True
+        self.visit(node.value)
+        self._in_args = False
+        self.src.write('\n')
+
     def visit_Pass(self, node):
         self.make_tab()
         self.src.write('pass\n')
@@ -1770,6 +3165,12 @@ class Printer(ast.NodeVisitor):
         self.src.write('.')
         self.src.write(node.attr)
 
+    def visit_Subscript(self, node):
+        self.visit(node.value)
+        self.src.write('[')
+        self.visit(node.slice)
+        self.src.write(']')
+
     def visit_BinOp(self, node):
         self.visit(node.left)
         self.src.write(' ')
@@ -1802,26 +3203,185 @@ class Printer(ast.NodeVisitor):
         self.src.write('or')
 
 
-def all_files_by_mask(mask):
-    for root, dirs, files in os.walk('.'):
+EXPORTED_TEMPLATE = '''\
+# Template %(name)r compiled by mint %(version)s, do not edit
+import marshal
+
+bases = %(bases)r
+code = marshal.loads(%(code)r)
+'''
+
+EXPORTED_PACKAGE = '''\
+# Templates compiled by mint %(version)s, do not edit
+import imp
+
+if imp.get_magic() != %(magic)r:
+    raise ImportError('Templates were compiled by other version of python, '
+                      'export them again')
+
+code_version = %(code_version)r
+pprint = %(pprint)r
+# template name -> module name
+templates = %(templates)r
+'''
+
+
+class PackageLoader(object):
+    '''
+    Loads templates from python package created by Loader.export
+    '''
+
+    def __init__(self, package, globals=None):
+        self.package = package
+        self.globals = globals or {}
+        self._package = __import__(package, fromlist=['templates'])
+        if getattr(self._package, 'code_version', None) != CODE_VERSION:
+            raise ImportError('Templates were compiled by other version of mint, '
+                              'export them again')
+        self.pprint = self._package.pprint
+        self._templates = {}
+
+    def list_templates(self):
+        return sorted(self._package.templates)
+
+    def get_template(self, template):
+        tmpl = self._templates.get(template)
+        if tmpl is None:
+            module_name = self._package.templates.get(template)
+            if module_name is None:
+                raise TemplateNotFound(template)
+            module = __import__('%s.%s' % (self.package, module_name), fromlist=['code'])
+            tmpl = Template(None, filename=template, globals=self.globals,
+                            pprint=self.pprint, code=module.code, bases=module.bases)
+            self._templates[template] = tmpl
+        return tmpl
+
+
+# loader of worker process
+_worker_loader = None
+
+
+def _init_worker(dirs, pprint, bytecode_cache, globals=None):
+    global _worker_loader
+    _worker_loader = Loader(cache=True, pprint=pprint, globals=globals,
+                            bytecode_cache=bytecode_cache, *dirs)
+
+
+def _precompile_worker(name):
+    template = _worker_loader.get_template(name)
+    return name, template.bases, marshal.dumps(template.compiled_code)
+
+
+def _render_worker(name):
+    return name, render_to_file(_worker_loader, name)
+
+
+def all_files_by_mask(mask, root='.'):
+    for root, dirs, files in os.walk(root):
         for basename in files:
             if fnmatch.fnmatch(basename, mask):
                 filename = os.path.join(root, basename)
                 yield filename
 
 
+def current_umask():
+    'Returns umask of process, it can be read only by setting new one'
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def write_file(filename, data):
+    'Writes data to temporary file and renames it, so file is never half written'
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp creates file readable only by owner
+        if os.path.exists(filename):
+            mode = os.stat(filename).st_mode
+        else:
+            # mode of files created by open()
+            mode = 0666 & ~current_umask()
+        os.chmod(tmp, mode & 0777)
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 def render_templates(*templates, **kw):
     loader = kw['loader']
     for template_name in templates:
         result = loader.get_template(template_name).render()
         if result:
-            open(template_name[:-4]+'html', 'w').write(result)
+            write_file(template_name[:-4]+'html', result.encode('utf-8'))
 
 
-def iter_changed(interval=1):
+def html_filename(location):
+    return os.path.splitext(location)[0] + '.html'
+
+
+def html_outdated(loader, template):
+    'Checks if html file of template is older than template or its base templates'
+    try:
+        html_mtime = os.stat(html_filename(loader.find(template))).st_mtime
+    except OSError:
+        return True
+    seen = set()
+    while template is not None and template not in seen:
+        seen.add(template)
+        if os.stat(loader.find(template)).st_mtime >= html_mtime:
+            return True
+        template = loader.get_base(template)
+    return False
+
+
+def render_to_file(loader, template):
+    'Renders template to html file next to it, returns time of rendering'
+    start = time.time()
+    result = loader.get_template(template).render()
+    if result:
+        write_file(html_filename(loader.find(template)), result.encode('utf-8'))
+    return time.time() - start
+
+
+def build_templates(loader, pattern='*.mint', workers=None, force=False):
+    '''
+    Renders templates matching pattern to html files next to them in pool of
+    worker processes (one per CPU by default). Templates with html files newer
+    than templates and their base templates are skipped unless force is True.
+    Returns list of (template name, seconds of rendering or None if it was
+    skipped). Loader globals must be picklable.
+    '''
+    names = loader.list_templates(pattern)
+    outdated = [name for name in names if force or html_outdated(loader, name)]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(outdated) <= 1:
+        timings = dict((name, render_to_file(loader, name)) for name in outdated)
+    else:
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (loader.dirs, loader.pprint, loader.bytecode_cache,
+                                     loader.globals))
+        try:
+            timings = dict(pool.map(_render_worker, outdated))
+        finally:
+            pool.close()
+            pool.join()
+    return [(name, timings.get(name)) for name in names]
+
+
+def poll_changes(mask='*.mint', interval=1, root='.'):
+    '''
+    Generates sets of files matching mask, modified since previous check.
+    Files are checked every interval seconds.
+    '''
     mtimes = {}
     while 1:
-        for filename in all_files_by_mask('*.mint'):
+        changed = set()
+        for filename in all_files_by_mask(mask, root):
             try:
                 mtime = os.stat(filename).st_mtime
             except OSError:
@@ -1832,10 +3392,189 @@ def iter_changed(interval=1):
                 continue
             elif mtime > old_time:
                 mtimes[filename] = mtime
-                yield filename
+                changed.add(filename)
+        if changed:
+            yield changed
         time.sleep(interval)
 
 
+def iter_changed(interval=1):
+    for changed in poll_changes('*.mint', interval):
+        for filename in sorted(changed):
+            yield filename
+
+
+def libc_inotify():
+    'Returns libc if it has inotify functions, else None'
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError):
+        return None
+    return libc
+
+
+def inotify_error(filename=None):
+    'Returns OSError of last failed inotify call'
+    import ctypes
+    errno = ctypes.get_errno()
+    if filename is None:
+        return OSError(errno, os.strerror(errno))
+    return OSError(errno, os.strerror(errno), filename)
+
+
+class InotifyWatcher(object):
+    '''
+    Watches directories tree for written, moved and created files with linux
+    inotify.
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root='.', libc=None):
+        self.root = root
+        self.libc = libc or libc_inotify()
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise inotify_error()
+        # watch descriptor -> directory
+        self.watches = {}
+        try:
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, root):
+        '''
+        Watches directory and its subdirectories, returns files in them.
+        Raises OSError if directory can not be watched (ENOSPC if
+        max_user_watches limit is reached for example).
+        '''
+        filenames = []
+        for dirpath, dirs, files in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, dirpath,
+                                             self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+            if wd < 0:
+                raise inotify_error(dirpath)
+            self.watches[wd] = dirpath
+            filenames.extend(os.path.join(dirpath, f) for f in files)
+        return filenames
+
+    def read(self, timeout=None):
+        '''
+        Returns names of changed files, waits for changes not longer than
+        timeout seconds (forever if None). Returns None if events were lost.
+        '''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        header = self.EVENT_HEADER
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = header.unpack_from(data, offset)
+            offset += header.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            filename = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                # files can be written to new directory before it is watched
+                changed.extend(self.add_tree(filename))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                changed.append(filename)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def iter_changes(mask='*.mint', interval=1, delay=0.1, root='.'):
+    '''
+    Generates sets of changed files matching mask. Uses inotify if it is
+    available, else files are checked every interval seconds. Changes
+    following each other in less than delay seconds are joined to one set.
+    If new directory can not be watched, all files are reported as changed
+    and files are checked every interval seconds.
+    '''
+    libc = libc_inotify()
+    try:
+        watcher = libc and InotifyWatcher(root, libc)
+    except OSError:
+        watcher = None
+    if not watcher:
+        for changed in poll_changes(mask, interval, root):
+            yield changed
+        return
+    try:
+        while 1:
+            try:
+                changed = watcher.read()
+                while changed is not None:
+                    more = watcher.read(delay)
+                    if more is None:
+                        # events were lost during delay
+                        changed = None
+                    elif more:
+                        changed.extend(more)
+                        continue
+                    break
+            except OSError:
+                break
+            if changed is None:
+                # events were lost, all files are changed
+                changed = list(all_files_by_mask(mask, root))
+            changed = set(f for f in changed
+                          if fnmatch.fnmatch(os.path.basename(f), mask) and os.path.isfile(f))
+            if changed:
+                yield changed
+    finally:
+        watcher.close()
+    # fallback to polling, changes made before it could be lost
+    changed = set(f for f in all_files_by_mask(mask, root) if os.path.isfile(f))
+    if changed:
+        yield changed
+    for changed in poll_changes(mask, interval, root):
+        yield changed
+
+
+def affected_templates(changed, mask='*.mint', root='.', graph=None):
+    '''
+    Returns sorted names (relative to root) of changed templates and
+    templates inheriting them directly or through other templates.
+    graph - DependencyGraph of templates in root, only bases of changed
+    templates are updated in it. Without graph all templates are scanned.
+    '''
+    loader = Loader(root)
+    names = [normalize_name(os.path.relpath(filename, root)) for filename in changed]
+    if graph is None:
+        graph = loader.dependency_graph(mask)
+    else:
+        for name in names:
+            try:
+                graph.update(name, loader.get_base(name))
+            except TemplateNotFound:
+                graph.remove(name)
+    affected = set(names)
+    for name in names:
+        affected.update(graph.descendants(name))
+    return sorted(affected)
+
+
 if __name__ == '__main__':
     import datetime
     from optparse import OptionParser
@@ -1856,9 +3595,30 @@ if __name__ == '__main__':
                       default=False,
                       help='Monitor current directory and subdirectories for changes in mint files. '
                            'And render corresponding html files.')
+    parser.add_option('-b', '--build', dest='build', action='store_true',
+                      default=False,
+                      help='Render mint files of current directory and subdirectories to html '
+                           'files in parallel. Templates not changed since last build are skipped.')
+    parser.add_option('-w', '--workers', dest='workers', metavar='N', type='int',
+                      default=None,
+                      help='Number of processes for --build (number of CPUs by default).')
+    parser.add_option('-e', '--export', dest='export', metavar='DIR',
+                      default=None,
+                      help='Compile mint files of current directory to python package DIR.')
     (options, args) = parser.parse_args()
-    loader = Loader('.', pprint=options.pprint)
-    if len(args) > 0:
+    loader = Loader('.', pprint=options.pprint, incremental=options.monitor)
+    if options.export:
+        names = loader.export(options.export)
+        print 'Exported %d templates to %s' % (len(names), options.export)
+    elif options.build:
+        start = time.time()
+        for name, seconds in build_templates(loader, workers=options.workers):
+            if seconds is None:
+                print 'Not changed: %s' % name
+            else:
+                print 'Rendered:    %s %.3fs' % (name, seconds)
+        print 'Total time:  %.3fs' % (time.time() - start)
+    elif len(args) > 0:
         template_name = args[0]
         template = loader.get_template(template_name)
         if options.code:
@@ -1866,8 +3626,9 @@ if __name__ == '__main__':
             printer.visit(template.tree())
             print printer.src.getvalue()
         elif options.tokenize:
-            for t in tokenizer(StringIO(template.source)):
-                print t
+            with open(template.filename, 'rb') as f:
+                for t in tokenizer(f):
+                    print t
         else:
             print template.render()
         if options.repeat > 0:
@@ -1882,11 +3643,15 @@ if __name__ == '__main__':
     elif options.monitor:
         curdir = os.path.abspath(os.getcwd())
         try:
-            render_templates(*all_files_by_mask('*.mint'), loader=loader)
+            render_templates(*[normalize_name(f) for f in all_files_by_mask('*.mint')],
+                             loader=loader)
+            # inheritance is scanned once and updated for changed files
+            graph = loader.dependency_graph('*.mint')
             print 'Monitoring for file changes...'
-            for changed_file in iter_changed():
-                print 'Changes in file: ', changed_file, datetime.datetime.now().strftime('%H:%M:%S')
-                render_templates(changed_file, loader=loader)
+            for changed_files in iter_changes('*.mint'):
+                for changed_file in sorted(changed_files):
+                    print 'Changes in file: ', changed_file, datetime.datetime.now().strftime('%H:%M:%S')
+                render_templates(*affected_templates(changed_files, graph=graph), loader=loader)
         except KeyboardInterrupt:
             pass
     else:
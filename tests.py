@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import time
 import glob
+import shutil
+import tempfile
 import unittest
+import threading
 import types
 from StringIO import StringIO
 
@@ -145,6 +150,100 @@ class TagsAndText(unittest.TestCase):
                                        '    @+attr( value1)').render(),
                                        '<tag attr="value value1"></tag>')
 
+    def test_attr_changing_in_slot(self):
+        'Attribute setter in slot, template without setters'
+        self.assertEqual(mint.Template('#def slot():\n'
+                                       '    @tag\n'
+                                       '        @+attr(value)\n'
+                                       '@div.class(a)\n'
+                                       '    #slot()').render(),
+                                       '<div class="a"><tag attr="value"></tag></div>')
+
+    def test_selfclosed(self):
+        'Self closed tags and text after'
+        self.assertEqual(mint.Template('@p\n'
+                                       '    @br\n'
+                                       '    text\n'
+                                       '    @img.src(/a.png)').render(),
+                         '<p><br />text\n<img src="/a.png" /></p>')
+
+    def test_selfclosed2(self):
+        'Self closed tags and text after (elements tree)'
+        self.assertEqual(mint.Template('@p\n'
+                                       '    @.class(a)\n'
+                                       '    @br\n'
+                                       '    text').render(),
+                         '<p class="a"><br />text\n</p>')
+
+    def test_selfclosed3(self):
+        'HTML5 void elements'
+        self.assertEqual(mint.Template('@table\n'
+                                       '    @.class(t)\n'
+                                       '    @col.span(2)\n'
+                                       '@wbr').render(),
+                         '<table class="t"><col span="2" /></table><wbr />')
+
+    def test_selfclosed_backends(self):
+        'Content of void elements is dropped by buffered and elements tree backends'
+        # changing of attributes forces elements tree
+        tree_suffix = '\n@i\n    @.a(1)'
+        for source, expected in (('@br text', '<br />'),
+                                 ('@img.src(a)\n    @p x', '<img src="a" />'),
+                                 ('@p\n    @br\n    text', '<p><br />text\n</p>')):
+            self.assertEqual(mint.Template(source).render(), expected)
+            self.assertEqual(mint.Template(source + tree_suffix).render(),
+                             expected + '<i a="1"></i>')
+
+    def test_static_attrs_changing(self):
+        'Changed static attributes are serialized again (elements tree)'
+        self.assertEqual(mint.Template('@tag.b(2).a(1)\n'
+                                       '    @.c({{ 3 }})\n'
+                                       '    @+a(1)\n'
+                                       '@tag.b(<).a(1).b(2)\n'
+                                       '    @tag.x({{ 1 }})\n'
+                                       '        @.y(2)').render(),
+                         '<tag a="11" b="2" c="3"></tag><tag a="1" b="&lt;">'
+                         '<tag x="1" y="2"></tag></tag>')
+
+    def test_deep_nesting(self):
+        'Serialization of elements tree deeper than recursion limit'
+        depth = sys.getrecursionlimit() + 100
+        for builder, expected in ((mint.TreeBuilder(), '<b><i>' * depth + '</i></b>' * depth),
+                                  (mint.PprintTreeBuilder(), None)):
+            for i in range(depth):
+                builder.start('b', {}, u'')
+                builder.start('i', {})
+            for i in range(depth):
+                builder.end('i')
+                builder.end('b')
+            result = builder.to_unicode()
+            if expected is not None:
+                self.assertEqual(result, expected)
+            else:
+                self.assert_(result.startswith('<b>\n  <i>\n    <b>\n'))
+                self.assertEqual(result.count('\n'), depth * 4 - 1)
+
+    def test_buffered(self):
+        'Templates without attributes changing do not build elements tree'
+        t = mint.Template('@tag.attr({{ value }})\n'
+                          '    text')
+        main = dict(t.module_functions())[mint.MAIN_FUNCTION]
+        self.assert_(mint.TAG_START not in main.func_code.co_names)
+        self.assertEqual(t.render(value='"'), '<tag attr="&quot;">text\n</tag>')
+
+    def test_static_folding(self):
+        'Static content is written with one call'
+        t = mint.Template('@html\n'
+                          '    @head\n'
+                          '        @title Title\n'
+                          '    @body.class(page)\n'
+                          '        -- comment')
+        main = [n for n in t.tree().body if n.name == mint.MAIN_FUNCTION][0]
+        self.assertEqual(main.body[1].value.args[0].s,
+                         u'<html><head><title>Title\n</title></head>'
+                         u'<body class="page"><!-- comment --></body></html>')
+        self.assertEqual(len(main.body), 3)
+
     def test_mint_comment(self):
         'mint comments'
         self.assertEqual(mint.Template('// comment message').render(), '')
@@ -184,6 +283,48 @@ class TagsAndText(unittest.TestCase):
                                 value=mint.Markup('<tag attr="&amp;" />')),
                          '<tag attr="&lt;tag attr=&quot;&amp;&quot; /&gt;"></tag>')
 
+    def test_escaping5(self):
+        'Numbers, strings without unsafe chars and objects with __html__'
+        class Html(object):
+            def __html__(self):
+                return u'<b>"</b>'
+        text = u'safe text'
+        self.assert_(mint.escape(text) is text)
+        self.assertEqual(mint.escape(5), u'5')
+        self.assertEqual(mint.escape(0.5, ctx='attr'), u'0.5')
+        self.assertEqual(mint.escape('<&>'), u'&lt;&amp;&gt;')
+        self.assertEqual(mint.escape(Html()), u'<b>"</b>')
+        self.assertEqual(mint.escape(Html(), ctx='attr'), u'&lt;b&gt;&quot;&lt;/b&gt;')
+
+    def test_escaping_url(self):
+        'Urls with unsafe schemes at start of url attributes'
+        template = mint.Template('@a.href({{ url }}).title({{ url }})\n'
+                                 '    @img.src(/{{ url }})')
+        self.assertEqual(template.render(url=u' Java\tScript:alert(1)'),
+                         '<a href="#" title=" Java\tScript:alert(1)">'
+                         '<img src="/ Java\tScript:alert(1)" /></a>')
+        self.assertEqual(template.render(url=u'/?a=1&b=2'),
+                         '<a href="/?a=1&amp;b=2" title="/?a=1&amp;b=2">'
+                         '<img src="//?a=1&amp;b=2" /></a>')
+        self.assertEqual(mint.Template('@a.href({{ url }})').render(url=mint.Markup('javascript:run()')),
+                         '<a href="javascript:run()"></a>')
+        self.assertEqual(mint.Template('@a.href(javascript:run)').render(),
+                         '<a href="javascript:run"></a>')
+
+    def test_escaping_url2(self):
+        'Scheme of whole url attribute value is checked'
+        for source in ('@a.href( {{ a + b }})', '@a.href({{ a }}{{ b }})',
+                       '@a.href({{ a }}{{ b }})\n    @.title(t)'):
+            self.assert_(mint.Template(source).render(a=u'java', b=u'script:run()')
+                         .startswith('<a href="#"'))
+        self.assertEqual(mint.Template('@a.href(/{{ a }}{{ b }})').render(a=u'java', b=u'script:'),
+                         '<a href="/javascript:"></a>')
+        self.assertEqual(mint.Template('@a.href(http://{{ a }})').render(a=u'javascript:'),
+                         '<a href="http://javascript:"></a>')
+        self.assertEqual(mint.Template('@object.data({{ a }})\n'
+                                       '@div.data({{ a }})').render(a=u'javascript:'),
+                         '<object data="#"></object><div data="javascript:"></div>')
+
     def test_spaces(self):
         'Whitespaces'
         self.assertRaises(SyntaxError, lambda: mint.Template('    \n'))
@@ -260,6 +401,42 @@ class Tokenizer(unittest.TestCase):
                           (mint.TOKEN_NEWLINE, '\n', 1, 20),
                           (mint.TOKEN_EOF, 'EOF', 2, 0)])
 
+    def test_tokens6(self):
+        'Long text runs are single tokens'
+        text = 'Lorem,ipsum,dolor,sit,amet;' * 100
+        self.assertEqual(list(mint.tokenizer(StringIO(text))),
+                         [(mint.TOKEN_TEXT, text, 1, 1),
+                          (mint.TOKEN_NEWLINE, '\n', 1, len(text) + 1),
+                          (mint.TOKEN_EOF, 'EOF', 2, 0)])
+        tokens = list(mint.tokenizer(StringIO('text@tag.attr(text)')))
+        self.assertEqual(tokens,
+                         [(mint.TOKEN_TEXT, 'text', 1, 1),
+                          (mint.TOKEN_TAG_START, '@', 1, 5),
+                          (mint.TOKEN_TEXT, 'tag', 1, 6),
+                          (mint.TOKEN_DOT, '.', 1, 9),
+                          (mint.TOKEN_TEXT, 'attr', 1, 10),
+                          (mint.TOKEN_PARENTHESES_OPEN, '(', 1, 14),
+                          (mint.TOKEN_TEXT, 'text', 1, 15),
+                          (mint.TOKEN_PARENTHESES_CLOSE, ')', 1, 19),
+                          (mint.TOKEN_NEWLINE, '\n', 1, 20),
+                          (mint.TOKEN_EOF, 'EOF', 2, 0)])
+
+    def test_sources(self):
+        'Strings, unicode and files are tokenized without StringIO'
+        tokens = [(mint.TOKEN_TAG_START, '@', 1, 1),
+                  (mint.TOKEN_TEXT, 'p', 1, 2),
+                  (mint.TOKEN_WHITESPACE, ' ', 1, 3),
+                  (mint.TOKEN_TEXT, u'ф', 1, 4),
+                  (mint.TOKEN_NEWLINE, '\n', 1, 5),
+                  (mint.TOKEN_EOF, 'EOF', 2, 0)]
+        self.assertEqual(list(mint.tokenizer('@p ф\n')), tokens)
+        self.assertEqual(list(mint.tokenizer(u'@p ф\n')), tokens)
+        with tempfile.TemporaryFile() as f:
+            f.write('@p ф\n')
+            f.flush()
+            self.assertEqual(list(mint.tokenizer(f)), tokens)
+        self.assertEqual(mint.Template(u'@p ф').render(), u'<p>ф\n</p>')
+
     def test_indent(self):
         'One indent'
         self.assertEqual(list(mint.tokenizer(StringIO('    '))),
@@ -598,6 +775,29 @@ class PythonPart(unittest.TestCase):
                                        '    {{ value }}\n'
                                        '#count()').render(value=1), '1\n')
 
+    def test_slotcall_writer(self):
+        'Slots called from template write to output of caller'
+        t = mint.Template('#def row(v):\n'
+                          '    @td {{ v }}\n'
+                          '#for v in values:\n'
+                          '    #row(v)')
+        main = dict(t.module_functions())[mint.MAIN_FUNCTION]
+        self.assert_('writer_slot_0__string__row' in main.func_code.co_names)
+        self.assertEqual(t.render(values=[1, 2]), '<td>1\n</td><td>2\n</td>')
+        self.assertEqual(t.slot('row')(1), '<td>1\n</td>')
+
+    def test_slotcall_writer2(self):
+        'Slot writes to elements tree of caller'
+        loader = DummyLoader({
+            'base.mint':mint.Template('@div\n'
+                                      '    @.class(a)\n'
+                                      '    #slot()'),
+        })
+        self.assertEqual(mint.Template('#base: base.mint\n'
+                                       '#def slot():\n'
+                                       '    @p text\n', loader=loader).render(),
+                         '<div class="a"><p>text\n</p></div>')
+
     def test_slotcall_from_python(self):
         'Slot call from python code'
         t = mint.Template('#def count(value):\n'
@@ -607,6 +807,89 @@ class PythonPart(unittest.TestCase):
         self.assert_(isinstance(slot, types.FunctionType))
         self.assertEqual(slot(1), '1\n')
 
+    def test_render_twice(self):
+        'Module body is executed once, functions get new globals for each rendering'
+        t = mint.Template('#def count():\n'
+                          '    {{ value }}\n'
+                          '#count()')
+        self.assertNotEqual(t.module_functions(), None)
+        self.assertEqual(t.render(value=1), '1\n')
+        self.assertEqual(t.render(value=2), '2\n')
+
+    def test_slot_default_from_context(self):
+        'Slot default argument depends on rendering globals'
+        t = mint.Template('#def count(v=value):\n'
+                          '    {{ v }}\n'
+                          '#count()')
+        self.assertEqual(t.module_functions(), None)
+        self.assertEqual(t.render(value=1), '1\n')
+        self.assertEqual(t.render(value=2), '2\n')
+
+    def test_slot_mutable_default(self):
+        'Mutable slot default argument is not shared between renderings'
+        t = mint.Template('#def s(x=[]):\n'
+                          '    {{ x.append(1) or len(x) }}\n'
+                          '#s()\n')
+        self.assertEqual(t.module_functions(), None)
+        self.assertEqual(t.render(), '1\n')
+        self.assertEqual(t.render(), '1\n')
+        t = mint.Template('#def s(x=(1, "a")):\n'
+                          '    {{ len(x) }}\n'
+                          '#s()\n')
+        self.assertNotEqual(t.module_functions(), None)
+        self.assertEqual(t.render(), '2\n')
+
+    def test_generate(self):
+        'Template rendering by parts'
+        t = mint.Template('@ul\n'
+                          '    #for v in values:\n'
+                          '        @li {{ v }}')
+        parts = t.generate(values=[1, 2])
+        self.assertEqual(parts.next(), '<ul>')
+        self.assertEqual(u''.join(parts), '<li>1\n</li><li>2\n</li></ul>')
+
+    def test_generate_tree(self):
+        'Template with elements tree is generated at once'
+        t = mint.Template('@ul\n'
+                          '    @.class(list)\n'
+                          '    #for v in values:\n'
+                          '        @li {{ v }}')
+        self.assertEqual(list(t.generate(values=[1])),
+                         ['<ul class="list"><li>1\n</li></ul>'])
+
+    def test_stream(self):
+        'Stream of encoded chunks'
+        t = mint.Template('@ul\n'
+                          '    #for v in values:\n'
+                          '        @li {{ v }}')
+        stream = t.stream(values=[u'\u0439', 2], buffer_size=10)
+        # first part is sent at once
+        self.assertEqual(list(stream), ['<ul>', '<li>\xd0\xb9\n</li>', '<li>2\n</li>', '</ul>'])
+
+    def test_generate_slots(self):
+        'Slots of inherited template are rendered by parts'
+        loader = DummyLoader({
+            'base.mint':mint.Template('@html\n'
+                                      '    @head\n'
+                                      '        @title Title\n'
+                                      '    @body\n'
+                                      '        #content()\n'),
+        })
+        t = mint.Template('#base: base.mint\n'
+                          '#def content():\n'
+                          '    #for v in values:\n'
+                          '        @p {{ v }}\n', loader=loader)
+        def values():
+            yield 1
+            # head is rendered before body loop ends
+            self.assertEqual(parts[0], '<html><head><title>Title\n</title></head><body>')
+            yield 2
+        parts = []
+        for part in t.generate(values=values()):
+            parts.append(part)
+        self.assertEqual(len(parts), 8)
+        self.assertEqual(u''.join(parts), t.render(values=[1, 2]))
+
     def test_inheritance(self):
         'One level inheritance'
         loader = DummyLoader({
@@ -708,6 +991,37 @@ class PythonPart(unittest.TestCase):
                                        '    overrided slot\n', loader=loader).render(),
                         'base slot\n\nbase2 slot\n\noverrided slot\n')
 
+    def test_deterministic_code(self):
+        'Compiled code does not differ between compilations'
+        loader = DummyLoader({
+            'base.mint':mint.Template('#def slot():\n'
+                                      '    base slot\n'
+                                      '#slot()'),
+        })
+        source = ('#base: base.mint\n'
+                  '#def slot():\n'
+                  '    {{ __base__() }}\n'
+                  '    overrided slot\n')
+        t1 = mint.Template(source, loader=loader)
+        t2 = mint.Template(source, loader=loader)
+        self.assertEqual(t1.compiled_code, t2.compiled_code)
+        self.assertEqual(sorted(n for n in t1.compiled_code.co_names if n.startswith('slot_')),
+                         ['slot_0__string__slot', 'slot_1__string__slot'])
+
+    def test_helpers_locals(self):
+        'Escape functions and utils are local variables of template functions'
+        template = mint.Template('#def row(utils):\n'
+                                 '    @td {{ utils }}\n'
+                                 '#for i in items:\n'
+                                 '    @p.class({{ i }}) {{ utils.doctype.html5 }}\n'
+                                 '    #row(i)\n')
+        main = template.namespace({})[mint.MAIN_FUNCTION].func_code
+        for name in (mint.ESCAPE_HELLPER, mint.ESCAPE_ATTR_HELPER, 'utils'):
+            self.assert_(name in main.co_varnames)
+        self.assertEqual(template.render(items=[1]),
+                         '<p class="1"><!DOCTYPE html>\n</p><td>1\n</td>')
+        self.assertEqual(mint.Template('{{ utils }}').render(utils='mine'), 'mine\n')
+
 
 class PprintTests(unittest.TestCase):
 
@@ -784,6 +1098,452 @@ class PprintTests(unittest.TestCase):
                          '</tag>\n')
 
 
+class LoaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.templates_dir = os.path.join(self.dir, 'templates')
+        os.mkdir(self.templates_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, source):
+        with open(os.path.join(self.templates_dir, name), 'w') as f:
+            f.write(source)
+
+    def test_bytecode_cache(self):
+        'Compiled templates are stored in bytecode cache'
+        cache_dir = os.path.join(self.dir, 'cache')
+        self.write('base.mint', '#def slot():\n'
+                                '    base slot\n'
+                                '#slot()')
+        self.write('index.mint', '#base: base.mint\n'
+                                 '#def slot():\n'
+                                 '    overrided slot\n')
+        loader = mint.Loader(self.templates_dir, bytecode_cache=cache_dir)
+        self.assertEqual(loader.get_template('index.mint').render(), 'overrided slot\n')
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        template = mint.Loader(self.templates_dir, bytecode_cache=cache_dir).get_template('index.mint')
+        self.assertEqual(template.bases, ('base.mint',))
+        self.assertEqual(template.render(), 'overrided slot\n')
+
+    def test_bytecode_cache_base_changed(self):
+        'Bytecode cache entry is not used when base template changed'
+        cache_dir = os.path.join(self.dir, 'cache')
+        self.write('base.mint', '@div\n'
+                                '    #slot()')
+        self.write('index.mint', '#base: base.mint\n'
+                                 '#def slot():\n'
+                                 '    text\n')
+        loader = mint.Loader(self.templates_dir, bytecode_cache=cache_dir)
+        self.assertEqual(loader.get_template('index.mint').render(), '<div>text\n</div>')
+        self.write('base.mint', '@p\n'
+                                '    #slot()')
+        loader = mint.Loader(self.templates_dir, bytecode_cache=cache_dir)
+        self.assertEqual(loader.get_template('index.mint').render(), '<p>text\n</p>')
+
+    def touch(self, name, mtime):
+        os.utime(os.path.join(self.templates_dir, name), (mtime, mtime))
+
+    def test_auto_reload(self):
+        'Cached template is recompiled when its base template changed'
+        self.write('base.mint', '@div\n'
+                                '    #slot()')
+        self.write('index.mint', '#base: base.mint\n'
+                                 '#def slot():\n'
+                                 '    text\n')
+        self.touch('base.mint', 1000)
+        loader = mint.Loader(self.templates_dir, cache=True, auto_reload=True, check_interval=0)
+        template = loader.get_template('index.mint')
+        self.assertEqual(template.render(), '<div>text\n</div>')
+        self.assert_(loader.get_template('index.mint') is template)
+        self.write('base.mint', '@p\n'
+                                '    #slot()')
+        self.touch('base.mint', 2000)
+        self.assertEqual(loader.get_template('index.mint').render(), '<p>text\n</p>')
+
+    def test_auto_reload_interval(self):
+        'Templates are not checked more often than once in check_interval'
+        self.write('index.mint', '@div')
+        self.touch('index.mint', 1000)
+        loader = mint.Loader(self.templates_dir, cache=True, auto_reload=True, check_interval=60)
+        template = loader.get_template('index.mint')
+        self.write('index.mint', '@p')
+        self.touch('index.mint', 2000)
+        self.assert_(loader.get_template('index.mint') is template)
+
+    def test_lru_cache(self):
+        'Least recently used templates are evicted from cache'
+        for name in ('a.mint', 'b.mint', 'c.mint'):
+            self.write(name, '@div')
+        cache = mint.LRUCache(max_entries=2)
+        loader = mint.Loader(self.templates_dir, cache=cache)
+        a = loader.get_template('a.mint')
+        loader.get_template('b.mint')
+        self.assert_(loader.get_template('a.mint') is a)
+        loader.get_template('c.mint')
+        self.assertEqual(sorted(cache._data), ['a.mint', 'c.mint'])
+        self.assertEqual(cache.stats(), dict(entries=2, size=cache.size,
+                                             hits=1, misses=3, evictions=1))
+
+    def test_lru_cache_eviction(self):
+        'Loader forgets modification times and parse results of evicted templates'
+        for name in ('a.mint', 'b.mint', 'c.mint'):
+            self.write(name, '@div')
+        evicted = []
+        cache = mint.LRUCache(max_entries=1)
+        loader = mint.Loader(self.templates_dir, cache=cache, auto_reload=True)
+        self.assertEqual(cache.on_evict, loader._evicted)
+        for name in ('a.mint', 'b.mint', 'c.mint'):
+            loader.get_template(name)
+        self.assertEqual(list(loader._mtimes), ['c.mint'])
+        self.assertEqual(list(loader._parsed), [loader.find('c.mint')])
+        cache = mint.LRUCache(max_entries=1, on_evict=lambda *args: evicted.append(args))
+        loader = mint.Loader(self.templates_dir, cache=cache)
+        a = loader.get_template('a.mint')
+        loader.get_template('b.mint')
+        self.assertEqual(evicted, [('a.mint', a)])
+
+    def test_lru_cache_add(self):
+        'Combined loader gets own cache with the same limits'
+        cache = mint.LRUCache(max_entries=2, max_size=1000)
+        loader = mint.Loader(self.templates_dir, cache=cache) + mint.Loader(self.templates_dir)
+        self.assert_(isinstance(loader._templates_cache, mint.LRUCache))
+        self.assert_(loader._templates_cache is not cache)
+        self.assertEqual((loader._templates_cache.max_entries, loader._templates_cache.max_size),
+                         (2, 1000))
+        self.assertEqual(loader._templates_cache.on_evict, loader._evicted)
+
+    def test_lru_cache_size(self):
+        'Cache size limit'
+        for name in ('a.mint', 'b.mint'):
+            self.write(name, '@div')
+        loader = mint.Loader(self.templates_dir)
+        size = mint.template_size(loader.get_template('a.mint'))
+        cache = mint.LRUCache(max_size=size * 3 / 2)
+        loader = mint.Loader(self.templates_dir, cache=cache)
+        loader.get_template('a.mint')
+        loader.get_template('b.mint')
+        self.assertEqual(list(cache._data), ['b.mint'])
+        self.assertEqual(cache.size, size)
+
+    def test_parse_once(self):
+        'Base templates are parsed once'
+        self.write('layout.mint', '@div\n'
+                                  '    #content()')
+        self.write('base.mint', '#base: layout.mint\n'
+                                '#def content():\n'
+                                '    #menu()')
+        for name in ('a.mint', 'b.mint'):
+            self.write(name, '#base: base.mint\n'
+                             '#def menu():\n'
+                             '    text\n')
+        parsed = []
+        get_mint_tree = mint.get_mint_tree
+        def counting_get_mint_tree(tokens_stream):
+            parsed.append(1)
+            return get_mint_tree(tokens_stream)
+        mint.get_mint_tree = counting_get_mint_tree
+        try:
+            loader = mint.Loader(self.templates_dir)
+            for name in ('a.mint', 'b.mint', 'a.mint'):
+                self.assertEqual(loader.get_template(name).render(), '<div>text\n</div>')
+        finally:
+            mint.get_mint_tree = get_mint_tree
+        self.assertEqual(len(parsed), 4)
+
+    def test_mapped_source(self):
+        'Templates are compiled from memory mapped files and do not keep source'
+        self.write('base.mint', '@div\n'
+                                '    #content()')
+        self.write('index.mint', '#base: base.mint\n'
+                                 '#def content():\n'
+                                 '    \xd1\x82ext\n')
+        self.write('empty.mint', '')
+        loader = mint.Loader(self.templates_dir, cache=True)
+        template = loader.get_template('index.mint')
+        self.assertEqual(template.source, None)
+        self.assertEqual(loader.get_template('base.mint').source, None)
+        self.assertEqual(template.render(), u'<div>\u0442ext\n</div>')
+        self.assertEqual(loader.get_template('empty.mint').render(), '')
+        self.assertEqual(loader.get_base('index.mint'), 'base.mint')
+        # unicode sources are parsed by loader too
+        template = mint.Template(u'#base: base.mint\n'
+                                 u'#def content():\n'
+                                 u'    \u0444\n', loader=loader)
+        self.assertEqual(template.render(), u'<div>\u0444\n</div>')
+
+    def test_incremental_parsing(self):
+        'Only changed blocks of template are parsed again'
+        self.write('index.mint', '@div\n'
+                                 '    @p {{ a }}\n'
+                                 '#if a:\n'
+                                 '    text\n'
+                                 '#else:\n'
+                                 '    other\n')
+        loader = mint.Loader(self.templates_dir, incremental=True)
+        template = loader.get_template('index.mint')
+        div = template.mint_tree().body[0]
+        source = '@h1 title\n' + template.source.replace('other', 'changed')
+        self.write('index.mint', source)
+        template = loader.get_template('index.mint')
+        mint_tree = template.mint_tree()
+        self.assert_(mint_tree.body[1] is div)
+        self.assert_(mint_tree == mint.get_mint_tree(mint.tokenizer(StringIO(source))))
+        self.assertEqual(template.render(a=0), '<h1>title\n</h1><div><p>0\n</p></div>changed\n')
+
+    def test_affected_templates(self):
+        'Templates inheriting changed template directly or through others'
+        os.mkdir(os.path.join(self.templates_dir, 'pages'))
+        self.write('base.mint', '#slot()')
+        self.write('layout.mint', '#base: base.mint\n')
+        self.write('pages/index.mint', '#base: layout.mint\n')
+        self.write('other.mint', 'text')
+        affected = mint.affected_templates([os.path.join(self.templates_dir, 'base.mint')],
+                                           root=self.templates_dir)
+        self.assertEqual(affected, ['base.mint', 'layout.mint', 'pages/index.mint'])
+        # graph is updated only for changed templates
+        graph = mint.Loader(self.templates_dir).dependency_graph()
+        self.write('other.mint', '#base: layout.mint\n')
+        os.remove(os.path.join(self.templates_dir, 'pages', 'index.mint'))
+        affected = mint.affected_templates([os.path.join(self.templates_dir, 'base.mint'),
+                                            os.path.join(self.templates_dir, 'other.mint'),
+                                            os.path.join(self.templates_dir, 'pages', 'index.mint')],
+                                           root=self.templates_dir, graph=graph)
+        self.assertEqual(affected, ['base.mint', 'layout.mint', 'other.mint', 'pages/index.mint'])
+        self.assertEqual(graph.bases, {'base.mint':None, 'layout.mint':'base.mint',
+                                       'other.mint':'layout.mint'})
+        self.assertEqual(graph.children, {'base.mint':set(['layout.mint']),
+                                          'layout.mint':set(['other.mint'])})
+
+    def test_affected_templates_names(self):
+        'Names of templates are normalized in dependency graph'
+        self.write('base.mint', '#slot()')
+        self.write('index.mint', '#base: ./base.mint\n')
+        loader = mint.Loader(self.templates_dir, incremental=True)
+        graph = loader.dependency_graph()
+        loader.get_template('./index.mint')
+        for i in range(3):
+            affected = mint.affected_templates([os.path.join(self.templates_dir, '.', 'base.mint')],
+                                               root=self.templates_dir, graph=graph)
+            self.assertEqual(affected, ['base.mint', 'index.mint'])
+            for name in affected:
+                loader.get_template(name)
+        self.assertEqual(graph.bases, {'base.mint':None, 'index.mint':'base.mint'})
+        self.assertEqual(len(loader._parsers), 2)
+
+    def test_dependency_graph(self):
+        'Inheritance of templates and invalidation of cache'
+        os.mkdir(os.path.join(self.templates_dir, 'pages'))
+        self.write('base.mint', '@div\n'
+                                '    #slot()')
+        self.write('layout.mint', '#base: base.mint\n'
+                                  '#def slot():\n'
+                                  '    layout\n')
+        self.write('pages/index.mint', '#base: layout.mint\n')
+        self.write('pages/about.mint', '// about\n'
+                                       '#base: base.mint\n')
+        self.write('other.mint', 'text')
+        loader = mint.Loader(self.templates_dir, cache=True)
+        graph = loader.dependency_graph()
+        self.assertEqual(graph.bases, {'base.mint':None, 'layout.mint':'base.mint',
+                                       'pages/index.mint':'layout.mint',
+                                       'pages/about.mint':'base.mint', 'other.mint':None})
+        self.assertEqual(graph.children, {'base.mint':set(['layout.mint', 'pages/about.mint']),
+                                          'layout.mint':set(['pages/index.mint'])})
+        self.assertEqual(graph.descendants('base.mint'),
+                         ['layout.mint', 'pages/about.mint', 'pages/index.mint'])
+        for name in graph.bases:
+            loader.get_template(name)
+        self.assertEqual(loader.invalidate('layout.mint'), ['layout.mint', 'pages/index.mint'])
+        self.assertEqual(sorted(loader._templates_cache),
+                         ['base.mint', 'other.mint', 'pages/about.mint'])
+        self.assert_(loader.find('layout.mint') not in loader._parsed)
+
+    def test_dependency_graph_updates(self):
+        'Dependency graph is kept by loader and updated without scanning templates'
+        self.write('base.mint', '#slot()')
+        self.write('other.mint', '#slot()')
+        self.write('layout.mint', '#base: base.mint\n')
+        self.write('index.mint', '#base: layout.mint\n')
+        loader = mint.Loader(self.templates_dir, cache=True)
+        graph = loader.dependency_graph()
+        self.assert_(loader.dependency_graph() is graph)
+        def list_templates(pattern):
+            raise AssertionError('templates are scanned')
+        loader.list_templates = list_templates
+        loader.get_template('index.mint')
+        self.write('layout.mint', '#base: other.mint\n')
+        self.assertEqual(loader.invalidate('layout.mint'), ['layout.mint', 'index.mint'])
+        self.assertEqual(graph.bases['layout.mint'], 'other.mint')
+        self.assertEqual(graph.descendants('base.mint'), [])
+        self.write('page.mint', '#base: ./other.mint\n')
+        loader.get_template('page.mint')
+        self.assertEqual(graph.descendants('other.mint'), ['index.mint', 'layout.mint', 'page.mint'])
+
+    def test_write_file_mode(self):
+        'New files are created with mode respecting umask, existing keep mode'
+        filename = os.path.join(self.templates_dir, 'index.html')
+        umask = os.umask(0027)
+        try:
+            mint.write_file(filename, 'text')
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(filename).st_mode & 0777, 0640)
+        os.chmod(filename, 0604)
+        mint.write_file(filename, 'new text')
+        self.assertEqual(os.stat(filename).st_mode & 0777, 0604)
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'new text')
+
+    def test_build_templates(self):
+        'Templates are rendered to html files, unchanged ones are skipped'
+        self.write('base.mint', '#def slot():\n'
+                                '    base\n'
+                                '@div\n'
+                                '    #slot()')
+        self.write('index.mint', '#base: base.mint\n'
+                                 '#def slot():\n'
+                                 '    {{ title }}\n')
+        self.write('other.mint', 'other')
+        loader = mint.Loader(self.templates_dir, globals={'title':u'\u0442itle'})
+        build = mint.build_templates(loader, workers=2)
+        self.assertEqual([name for name, seconds in build],
+                         ['base.mint', 'index.mint', 'other.mint'])
+        self.assert_(all(seconds is not None for name, seconds in build))
+        with open(os.path.join(self.templates_dir, 'index.html')) as f:
+            self.assertEqual(f.read(), '<div>\xd1\x82itle\n</div>')
+        for name in ('base', 'index', 'other'):
+            self.touch(name + '.html', time.time() + 10)
+        self.touch('base.mint', time.time() + 20)
+        self.assertEqual([name for name, seconds in mint.build_templates(loader, workers=1)
+                          if seconds is not None],
+                         ['base.mint', 'index.mint'])
+
+    def test_iter_changes(self):
+        'Burst of changes is reported once'
+        self.write('index.mint', 'text')
+        self.write('other.mint', 'text')
+        def change():
+            time.sleep(0.3)
+            for i in range(3):
+                self.write('index.mint', 'new text %d' % i)
+                self.touch('index.mint', time.time() + i + 1)
+                time.sleep(0.02)
+        for changes in (mint.iter_changes(root=self.templates_dir),
+                        mint.poll_changes(interval=0.1, root=self.templates_dir)):
+            thread = threading.Thread(target=change)
+            thread.start()
+            self.assertEqual(changes.next(), set([os.path.join(self.templates_dir, 'index.mint')]))
+            thread.join()
+
+    def test_iter_changes_lost_events(self):
+        'Events lost while changes are joined and failed watches are not ignored'
+        self.write('index.mint', 'text')
+        self.write('other.mint', 'text')
+        index = os.path.join(self.templates_dir, 'index.mint')
+        class FakeLibc(object):
+            def inotify_init(self):
+                return os.open(os.devnull, os.O_RDONLY)
+            def inotify_add_watch(self, fd, path, mask):
+                return -1
+        self.assertRaises(OSError, mint.InotifyWatcher, self.templates_dir, FakeLibc())
+        class FakeWatcher(object):
+            reads = [[index], None]
+            def __init__(self, root, libc):
+                pass
+            def read(self, timeout=None):
+                return self.reads.pop(0)
+            def close(self):
+                pass
+        InotifyWatcher, libc_inotify = mint.InotifyWatcher, mint.libc_inotify
+        mint.InotifyWatcher, mint.libc_inotify = FakeWatcher, lambda: FakeLibc()
+        try:
+            all_files = set([index, os.path.join(self.templates_dir, 'other.mint')])
+            changes = mint.iter_changes(root=self.templates_dir)
+            self.assertEqual(changes.next(), all_files)
+            # new directory can not be watched, files are polled
+            def read(timeout=None):
+                raise OSError(28, 'No space left on device')
+            FakeWatcher.read = staticmethod(read)
+            changes = mint.iter_changes(root=self.templates_dir)
+            self.assertEqual(changes.next(), all_files)
+        finally:
+            mint.InotifyWatcher, mint.libc_inotify = InotifyWatcher, libc_inotify
+
+    def test_concurrent_compilation(self):
+        'Template is compiled once for concurrent requests'
+        self.write('index.mint', '@div')
+        compiled = []
+        class SlowLoader(mint.Loader):
+            def _load_template(self, *args):
+                compiled.append(args[0])
+                time.sleep(0.05)
+                return mint.Loader._load_template(self, *args)
+        loader = SlowLoader(self.templates_dir, cache=True)
+        start = threading.Event()
+        templates = []
+        def request():
+            start.wait()
+            templates.append(loader.get_template('index.mint'))
+        threads = [threading.Thread(target=request) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(compiled, ['index.mint'])
+        self.assertEqual(len(templates), 8)
+        self.assert_(all(t is templates[0] for t in templates))
+
+    def test_precompile(self):
+        'All templates are compiled in worker processes and cached'
+        cache_dir = os.path.join(self.dir, 'cache')
+        os.mkdir(os.path.join(self.templates_dir, 'pages'))
+        self.write('base.mint', '@div\n'
+                                '    #slot()')
+        self.write('layout.mint', '#base: base.mint\n'
+                                  '#def slot():\n'
+                                  '    @p\n'
+                                  '        #content()\n')
+        self.write('pages/index.mint', '#base: layout.mint\n'
+                                       '#def content():\n'
+                                       '    index\n')
+        self.write('readme.txt', 'not a template')
+        loader = mint.Loader(self.templates_dir, cache=True, bytecode_cache=cache_dir)
+        self.assertEqual(loader.dependency_graph().levels(),
+                         [['base.mint'], ['layout.mint'], ['pages/index.mint']])
+        self.assertEqual(loader.precompile(workers=2),
+                         ['base.mint', 'layout.mint', 'pages/index.mint'])
+        self.assertEqual(len(loader._templates_cache), 3)
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+        template = loader.get_template('pages/index.mint')
+        self.assertEqual(template.bases, ('layout.mint', 'base.mint'))
+        self.assertEqual(template.render(), '<div><p>index\n</p></div>')
+
+    def test_export(self):
+        'Exported templates are loaded without compilation'
+        self.write('base.mint', '@div\n'
+                                '    #slot()')
+        self.write('index.mint', '#base: base.mint\n'
+                                 '#def slot():\n'
+                                 '    @p {{ text }}\n')
+        package = 'exported_' + os.path.basename(self.dir)
+        loader = mint.Loader(self.templates_dir)
+        self.assertEqual(loader.export(os.path.join(self.dir, package)),
+                         ['base.mint', 'index.mint'])
+        sys.path.insert(0, self.dir)
+        try:
+            package_loader = mint.PackageLoader(package, globals={'text': u'global'})
+            template = package_loader.get_template('index.mint')
+        finally:
+            sys.path.remove(self.dir)
+        self.assertEqual(template.bases, ('base.mint',))
+        self.assertEqual(template.render(), '<div><p>global\n</p></div>')
+        self.assertEqual(template.render(text=u'<>'), '<div><p>&lt;&gt;\n</p></div>')
+        self.assertRaises(mint.TemplateNotFound, package_loader.get_template, 'other.mint')
+
 
 if __name__ == '__main__':
     unittest.main()